@@ -1,20 +1,240 @@
 import json
+import re
 import sys
+from types import MappingProxyType
 from typing import Callable
 
-import jsonschema
 from abc import abstractmethod
+from eventLog import event_log
 
 
 def log(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+LARGE_STRING_BYTES = 4096  # Longer JSON strings are not decoded for the message types with skip_strings
+SKIPPED_STRING = "\0skipped\0"  # What the validators and parse_request see in place of a skipped string
+_SKIPPED_LITERAL = b'"\\u0000skipped\\u0000"'
+_QUOTE = re.compile(rb'"')
+
+
+def skip_large_strings(body: bytes | memoryview) -> bytes | memoryview:
+    """
+    The JSON body with the strings longer than LARGE_STRING_BYTES replaced by SKIPPED_STRING, so that decoding it only builds
+    the structure and the short values. Only the quotes are searched for, from the start of the body, so the skipped strings
+    are never decoded, nor checked to be valid JSON strings
+    """
+    if len(body) <= LARGE_STRING_BYTES:
+        return body
+    parts = []
+    kept = pos = 0  # Beginning of the body not yet added to parts, and of the body still to scan
+    while (match := _QUOTE.search(body, pos)) is not None:
+        start = end = match.start()
+        while True:
+            if (match := _QUOTE.search(body, end + 1)) is None:
+                return body  # Unterminated string, reported by json.loads
+            end = match.start()
+            backslashes = 0
+            while body[end - 1 - backslashes] == 0x5C:
+                backslashes += 1
+            if backslashes % 2 == 0:
+                break
+        if end - start - 1 > LARGE_STRING_BYTES:
+            parts += [body[kept:start], _SKIPPED_LITERAL]
+            kept = end + 1
+        pos = end + 1
+    if len(parts) == 0:
+        return body
+    parts.append(body[kept:])
+    return b"".join(parts)
+
+
 def method_and_uri_match(method: str, uri: str, wanted_method: str, wanted_uri: str) -> bool:
     return method == wanted_method and uri == wanted_uri
 
 
+class SchemaCompiler:
+    """
+    Generates a plain Python function for the simple object/required/type schemas used by the message types.
+    Schemas with other keywords can't be compiled, and are left to jsonschema
+    """
+    ANNOTATIONS = {"$schema", "self", "format", "title", "description"}  # Not asserted by jsonschema without a format checker either
+    KEYWORDS = ANNOTATIONS | {"type", "properties", "required", "additionalProperties", "pattern"}
+    TYPE_CHECKS = {
+        "object": "isinstance({0}, dict)",
+        "array": "isinstance({0}, list)",
+        "string": "isinstance({0}, str)",
+        "boolean": "isinstance({0}, bool)",
+        "null": "{0} is None",
+        "integer": "(isinstance({0}, int) and not isinstance({0}, bool) or isinstance({0}, float) and {0}.is_integer())",
+        "number": "(isinstance({0}, (int, float)) and not isinstance({0}, bool))",
+    }
+
+    @classmethod
+    def supports(cls, schema: dict) -> bool:
+        if not isinstance(schema, dict) or not set(schema).issubset(cls.KEYWORDS):
+            return False
+        if "type" in schema and not (isinstance(schema["type"], str) and schema["type"] in cls.TYPE_CHECKS):  # A list of types is left to jsonschema
+            return False
+        if not isinstance(schema.get("additionalProperties", True), bool):
+            return False
+        return all(cls.supports(subschema) for subschema in schema.get("properties", {}).values())
+
+    @classmethod
+    def compile(cls, schema: dict) -> Callable[[object], str | None]:
+        namespace = {}
+        lines = ["def validate(v0):"]
+        cls._emit(schema, "v0", 1, lines, namespace)
+        lines.append("    return None")
+        exec("\n".join(lines), namespace)
+        return namespace["validate"]
+
+    @classmethod
+    def _emit(cls, schema: dict, var: str, depth: int, lines: list[str], namespace: dict):
+        indent = "    " * depth
+        if "type" in schema:
+            lines.append(indent + f"if not {cls.TYPE_CHECKS[schema['type']].format(var)}:")
+            lines.append(indent + f"    return repr({var}) + {' is not of type ' + repr(schema['type'])!r}")  # Messages quoted by repr, as the schema values may contain quotes
+        if "pattern" in schema:
+            name = f"pattern{len(namespace)}"
+            namespace[name] = re.compile(schema["pattern"])
+            namespace["SKIPPED_STRING"] = SKIPPED_STRING  # Never matched, since its actual value is unknown
+            lines.append(indent + f"if isinstance({var}, str) and ({var} == SKIPPED_STRING or not {name}.search({var})):")
+            lines.append(indent + f"    return repr({var}) + {' does not match ' + repr(schema['pattern'])!r}")
+        properties = schema.get("properties", {})
+        if len(properties) == 0 and len(schema.get("required", [])) == 0 and schema.get("additionalProperties", True):
+            return
+        lines.append(indent + f"if isinstance({var}, dict):")
+        for required in schema.get("required", []):
+            lines.append(indent + f"    if {required!r} not in {var}:")
+            lines.append(indent + f"        return {repr(required) + ' is a required property'!r}")
+        if not schema.get("additionalProperties", True):
+            name = f"allowed{len(namespace)}"
+            namespace[name] = frozenset(properties)
+            lines.append(indent + f"    if not {name}.issuperset({var}):")
+            lines.append(indent + f"        return \"Additional properties are not allowed\"")
+        for i, (key, subschema) in enumerate(properties.items()):
+            subvar = f"v{depth}_{i}"
+            lines.append(indent + f"    if {key!r} in {var}:")
+            lines.append(indent + f"        {subvar} = {var}[{key!r}]")
+            cls._emit(subschema, subvar, depth + 2, lines, namespace)
+
+
+class SchemaRegistry:
+    """
+    Loads every schema file once, when first needed, and keeps one compiled validator for each (MessageType, getter) pair.
+    A validator returns None if the instance is valid, or the error message.
+    jsonschema is only imported to check the schemas (check_schemas()) or to validate the schemas codegen can't compile
+    """
+    BACKENDS = ["jsonschema", "codegen"]
+
+    def __init__(self, backend: str = "jsonschema"):
+        self.backend = backend
+        self.schemas: dict[str, dict] = {}
+        self.validators: dict[str, Callable[[object], str | None]] = {}
+        self.message_types: dict[type, list[tuple[Callable[[dict], dict], Callable[[object], str | None]]]] = {}
+        self.generated: set[str] = set()  # Schemas compiled by codegen
+        self.skipping: dict[type, bool] = {}
+
+    def set_backend(self, backend: str):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown schema backend {backend}")
+        if backend == self.backend:  # Keeps the validators compiled before forking (forkServer.prewarm)
+            return
+        self.backend = backend
+        self.validators.clear()
+        self.message_types.clear()
+        self.generated.clear()
+        self.skipping.clear()
+
+    def load(self, filename: str) -> dict:
+        if filename not in self.schemas:
+            with open(filename, "r") as schema_file:
+                self.schemas[filename] = json.load(schema_file)
+        return self.schemas[filename]
+
+    def compile(self, filename: str) -> Callable[[object], str | None]:
+        if filename not in self.validators:
+            schema = self.load(filename)
+            if self.backend == "codegen" and SchemaCompiler.supports(schema):
+                self.validators[filename] = SchemaCompiler.compile(schema)
+                self.generated.add(filename)
+            else:
+                import jsonschema
+                validator = jsonschema.validators.validator_for(schema)(schema)
+
+                def validate(instance: object) -> str | None:
+                    error = jsonschema.exceptions.best_match(validator.iter_errors(instance))
+                    return None if error is None else error.message
+
+                self.validators[filename] = validate
+        return self.validators[filename]
+
+    def get(self, message_type: type) -> list[tuple[Callable[[dict], dict], Callable[[object], str | None]]]:
+        if message_type not in self.message_types:
+            self.message_types[message_type] = [(json_getter, self.compile(filename)) for json_getter, filename in message_type.schemas().items()]
+        return self.message_types[message_type]
+
+    def skips_strings(self, message_type: type) -> bool:
+        """
+        Whether the large strings of the bodies of message_type are skipped: only if it allows it, and if all its schemas are
+        compiled by codegen, which never matches SKIPPED_STRING against a pattern (jsonschema would)
+        """
+        if message_type not in self.skipping:
+            self.get(message_type)
+            self.skipping[message_type] = message_type.skip_strings and all(filename in self.generated for filename in message_type.schemas().values())
+        return self.skipping[message_type]
+
+
+schema_registry = SchemaRegistry()
+
+
+class InvalidBody(ValueError):
+    pass
+
+
+_NOT_DECODED = object()
+
+
+class ParsedRequest:
+    """
+    A request whose body is decoded at most once, shared by match_request, validate_schemas and parse_request
+    """
+
+    def __init__(self, method: str, uri: str, headers: dict[str, str], body: str | bytes | memoryview):
+        self.method = method
+        self.uri = uri
+        self.headers = headers
+        self.body = body
+        self._json = _NOT_DECODED
+        self.json_error: ValueError | None = None
+
+    @property
+    def json(self) -> object:
+        return self.decode()
+
+    def decode(self, skip_strings: bool = False) -> object:
+        """
+        The decoded body, the first call choosing whether its large strings are skipped (skip_large_strings)
+        """
+        if self._json is _NOT_DECODED:
+            body = skip_large_strings(self.body) if skip_strings and not isinstance(self.body, str) else self.body
+            try:
+                self._json = json.loads((bytes(body) if isinstance(body, memoryview) else body) or "null")
+            except ValueError as e:  # Also a body that isn't UTF-8
+                event_log.debug("Invalid JSON body: %s", e)
+                self.json_error = e
+                self._json = None
+        if self.json_error is not None:
+            raise InvalidBody(self.json_error)
+        return self._json
+
+
 class MessageType:
+    method = "POST"
+    headers_only = False  # Whether the verdict only depends on the request line and the headers, so the body is never waited for
+    skip_strings = False  # Whether the strings of the body longer than LARGE_STRING_BYTES are never needed, and so not decoded
+
     @property
     @abstractmethod
     def url(self):
@@ -26,12 +246,12 @@ class MessageType:
         pass
 
     @classmethod
-    def match_request(cls, method: str, uri: str, headers: dict[str, str], body: str) -> bool:
-        return method_and_uri_match(method, uri, "POST", cls.url)
+    def match_request(cls, request: ParsedRequest) -> bool:
+        return method_and_uri_match(request.method, request.uri, cls.method, cls.url)
 
     @classmethod
     @abstractmethod
-    def parse_request(cls, session: dict, method: str, uri: str, headers: dict[str, str], body: str) -> (dict, dict):
+    def parse_request(cls, session: dict, request: ParsedRequest) -> (dict, dict):
         pass
 
     @classmethod
@@ -45,42 +265,58 @@ class MessageType:
         pass
 
     @classmethod
-    def validate_schemas(cls, target_cls: type, body: str | object) -> bool:
-        if len(target_cls.schemas()) == 0 and len(body) == 0:
-            return True
-        if isinstance(body, str):
+    def check_request(cls, session: dict, request: ParsedRequest) -> (dict, dict, str | None):
+        """
+        Runs parse_request and validate_request on the same decoded body, returning the updated session, the request data and the validation error.
+        A body that isn't valid JSON is reported once here, instead of by every stage that would decode it
+        """
+        session, request_data = cls.parse_request(session, request)
+        if request.json_error is not None:
+            return session, request_data, "Invalid JSON body: " + str(request.json_error)
+        return session, request_data, cls.validate_request(session, request_data)
+
+    @classmethod
+    def validate_schemas(cls, target_cls: type, body: ParsedRequest | str | object) -> bool:
+        validators = schema_registry.get(target_cls)
+        if isinstance(body, ParsedRequest):
+            if len(validators) == 0 and len(body.body) == 0:
+                return True
+            try:
+                json_body = body.decode(schema_registry.skips_strings(target_cls))
+            except InvalidBody:
+                return False
+        elif isinstance(body, str):
+            if len(validators) == 0 and len(body) == 0:
+                return True
             try:
                 json_body = json.loads(body or "null")
             except json.decoder.JSONDecodeError as e:
-                log(e)
+                event_log.debug("Invalid JSON body: %s", e)
                 return False
         else:
             json_body = body
-        for json_getter, json_schema_filename in target_cls.schemas().items():
+        for json_getter, validator in validators:
             try:
-                with open(json_schema_filename, "r") as json_schema_file:
-                    json_schema = json.load(json_schema_file)
                 json_fragment = json_getter(json_body)
-                try:
-                    jsonschema.validate(json_fragment, json_schema)
-                except jsonschema.exceptions.ValidationError as e:
-                    log(e)
-                    return False
-            except jsonschema.exceptions as e:
-                log(e)
+            except (KeyError, IndexError, TypeError) as e:
+                event_log.debug("Body of %s without the part to validate: %r", target_cls.__name__, e)
+                return False
+            if (error := validator(json_fragment)) is not None:
+                event_log.debug("Body of %s not matching its schema: %s", target_cls.__name__, error)
                 return False
         return True
 
 
 class InitMessageType(MessageType):
     url = "/function/init"
+    headers_only = True
 
     @classmethod
     def schemas(cls) -> dict[Callable[[dict], dict], str]:
         return {}
 
     @classmethod
-    def parse_request(cls, session: dict, method: str, uri: str, headers: dict[str, str], body: str) -> (dict, dict):
+    def parse_request(cls, session: dict, request: ParsedRequest) -> (dict, dict):
         return session, {}
 
     @classmethod
@@ -102,8 +338,8 @@ class ProductsMessageType(MessageType):
         }
 
     @classmethod
-    def parse_request(cls, session: dict, method: str, uri: str, headers: dict[str, str], body: str) -> (dict, dict):
-        if not super().validate_schemas(cls, body):
+    def parse_request(cls, session: dict, request: ParsedRequest) -> (dict, dict):
+        if not super().validate_schemas(cls, request):
             return session, {"invalid": True}
         return session, {}
 
@@ -120,14 +356,15 @@ class ProductsMessageType(MessageType):
 
 class CategoriesMessageType(MessageType):  # Note: the response code for this message is always 500 for a bug in the server code
     url = "/function/product-catalog-api/categories"
+    headers_only = True
 
     @classmethod
     def schemas(cls) -> dict[Callable[[dict], dict], str]:
         return {}
 
     @classmethod
-    def parse_request(cls, session: dict, method: str, uri: str, headers: dict[str, str], body: str) -> (dict, dict):
-        if not super().validate_schemas(cls, body):
+    def parse_request(cls, session: dict, request: ParsedRequest) -> (dict, dict):
+        if not super().validate_schemas(cls, request):
             return session, {"invalid": True}
         return session, {}
 
@@ -151,14 +388,10 @@ class BuildProductMessageType(MessageType):
         }
 
     @classmethod
-    def parse_request(cls, session: dict, method: str, uri: str, headers: dict[str, str], body: str) -> (dict, dict):
-        try:
-            json_body = json.loads(body)
-        except json.decoder.JSONDecodeError:
+    def parse_request(cls, session: dict, request: ParsedRequest) -> (dict, dict):
+        if not super().validate_schemas(cls, request):
             return session, {"invalid": True}
-        if not super().validate_schemas(cls, json_body):
-            return session, {"invalid": True}
-        return session, {"id": json_body["data"]["id"]}
+        return session, {"id": request.json["data"]["id"]}
 
     @classmethod
     def validate_request(cls, session: dict, request_data: dict) -> str | None:
@@ -175,6 +408,7 @@ class BuildProductMessageType(MessageType):
 
 class ProductImageMessageType(MessageType):
     url = "/function/product-catalog-builder/image"
+    skip_strings = True  # The image
 
     @classmethod
     def schemas(cls) -> dict[Callable[[dict], dict], str]:
@@ -184,14 +418,10 @@ class ProductImageMessageType(MessageType):
         }
 
     @classmethod
-    def parse_request(cls, session: dict, method: str, uri: str, headers: dict[str, str], body: str) -> (dict, dict):
-        try:
-            json_body = json.loads(body)
-        except json.decoder.JSONDecodeError:
+    def parse_request(cls, session: dict, request: ParsedRequest) -> (dict, dict):
+        if not super().validate_schemas(cls, request):
             return session, {"invalid": True}
-        if not super().validate_schemas(cls, json_body):
-            return session, {"invalid": True}
-        return session, {"id": json_body["data"]["id"]}
+        return session, {"id": request.json["data"]["id"]}
 
     @classmethod
     def validate_request(cls, session: dict, request_data: dict) -> str | None:
@@ -214,8 +444,8 @@ class ProductPurchaseMessageType(MessageType):
         }
 
     @classmethod
-    def parse_request(cls, session: dict, method: str, uri: str, headers: dict[str, str], body: str) -> (dict, dict):
-        if not super().validate_schemas(cls, body):
+    def parse_request(cls, session: dict, request: ParsedRequest) -> (dict, dict):
+        if not super().validate_schemas(cls, request):
             return session, {"invalid": True}
         return session, {}
 
@@ -241,14 +471,10 @@ class PhotographerRegisterMessageType(MessageType):
         }
 
     @classmethod
-    def parse_request(cls, session: dict, method: str, uri: str, headers: dict[str, str], body: str) -> (dict, dict):
-        try:
-            json_body = json.loads(body)
-        except json.decoder.JSONDecodeError:
+    def parse_request(cls, session: dict, request: ParsedRequest) -> (dict, dict):
+        if not super().validate_schemas(cls, request):
             return session, {"invalid": True}
-        if not super().validate_schemas(cls, json_body):
-            return session, {"invalid": True}
-        return session, {"phone": json_body["data"]["phone"]}
+        return session, {"phone": request.json["data"]["phone"]}
 
     @classmethod
     def validate_request(cls, session: dict, request_data: dict) -> str | None:
@@ -272,14 +498,10 @@ class PhotoRequestMessageType(MessageType):
         }
 
     @classmethod
-    def parse_request(cls, session: dict, method: str, uri: str, headers: dict[str, str], body: str) -> (dict, dict):
-        try:
-            json_body = json.loads(body)
-        except json.decoder.JSONDecodeError:
+    def parse_request(cls, session: dict, request: ParsedRequest) -> (dict, dict):
+        if not super().validate_schemas(cls, request):
             return session, {"invalid": True}
-        if not super().validate_schemas(cls, json_body):
-            return session, {"invalid": True}
-        return session, {"id": json_body["data"]["id"]}
+        return session, {"id": request.json["data"]["id"]}
 
     @classmethod
     def validate_request(cls, session: dict, request_data: dict) -> str | None:
@@ -294,6 +516,7 @@ class PhotoRequestMessageType(MessageType):
 
 class PhotoAssignmentMessageType(MessageType):
     url = "/function/product-photos/photos"
+    skip_strings = True  # The media URL
 
     @classmethod
     def schemas(cls) -> dict[Callable[[dict], dict], str]:
@@ -302,14 +525,10 @@ class PhotoAssignmentMessageType(MessageType):
         }
 
     @classmethod
-    def parse_request(cls, session: dict, method: str, uri: str, headers: dict[str, str], body: str) -> (dict, dict):
-        try:
-            json_body = json.loads(body)
-        except json.decoder.JSONDecodeError:
+    def parse_request(cls, session: dict, request: ParsedRequest) -> (dict, dict):
+        if not super().validate_schemas(cls, request):
             return session, {"invalid": True}
-        if not super().validate_schemas(cls, json_body):
-            return session, {"invalid": True}
-        return session, {"from": json_body["From"]}
+        return session, {"from": request.json["From"]}
 
     @classmethod
     def validate_request(cls, session: dict, request_data: dict) -> str | None:
@@ -324,14 +543,56 @@ class PhotoAssignmentMessageType(MessageType):
         return session, request_data
 
 
-fail = False
-for message_type in MessageType.__subclasses__():
-    for schema in message_type.schemas().values():
-        with open(schema, "r") as schema_file:
-            try:
-                json.load(schema_file)
-            except json.decoder.JSONDecodeError as e:
-                log(e)
-                fail = True
-if fail:
-    sys.exit(1)
+class MessageRouter:
+    """
+    Finds the message type of a request with a single lookup of (method, uri), instead of calling match_request on every type.
+    Types overriding match_request can't be indexed, and are still tried one by one after the lookup
+    """
+
+    def __init__(self, message_types: list[type[MessageType]]):
+        routes = {}
+        unrouted = []
+        for message_type in message_types:
+            if message_type.match_request.__func__ is not MessageType.match_request.__func__:
+                unrouted.append(message_type)
+            elif (message_type.method, message_type.url) in routes:
+                raise ValueError(f"{message_type.__name__} has the same method and url of {routes[(message_type.method, message_type.url)].__name__}")
+            else:
+                routes[(message_type.method, message_type.url)] = message_type
+        self.routes = MappingProxyType(routes)
+        self.unrouted = tuple(unrouted)
+
+    def route(self, request: ParsedRequest) -> type[MessageType] | None:
+        message_type = self.routes.get((request.method, request.uri))
+        if message_type is not None:
+            return message_type
+        for message_type in self.unrouted:
+            if message_type.match_request(request):
+                return message_type
+        return None
+
+
+message_router = MessageRouter(MessageType.__subclasses__())
+
+
+def check_schemas() -> bool:
+    """
+    Loads, checks and compiles the schemas of all message types, logging the invalid ones.
+    Run at the startup of the long-running processes, or with python MessageTypes.py after changing a schema
+    """
+    import jsonschema
+    valid = True
+    for message_type in MessageType.__subclasses__():
+        try:
+            for filename in message_type.schemas().values():
+                schema = schema_registry.load(filename)
+                jsonschema.validators.validator_for(schema).check_schema(schema)
+            schema_registry.get(message_type)
+        except (OSError, json.decoder.JSONDecodeError, jsonschema.exceptions.SchemaError) as e:
+            log(e)
+            valid = False
+    return valid
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check_schemas() else 1)
@@ -0,0 +1,97 @@
+import queue
+import threading
+import time
+from collections import deque
+from MessageTypes import *
+from eventLog import event_log
+from httpParser import preview
+from verifier import Verifier
+
+# Observe-only verification for listener.py --audit, for the deployments that only need to detect the violations: every message
+# is forwarded as soon as it is received, and queued for a background thread that runs the same verification (reassembly, schemas
+# and FSM) and records the messages it would have blocked, with the depth of the queue and the lag of the verification.
+# The codes can't be checked, since the responses reach the client without them
+
+MAX_QUEUED_MESSAGES = 100000
+RECENT_VIOLATIONS = 100
+
+
+class Auditor:
+    """
+    Owns the verifier once started: only its thread may use it, sweeps included
+    """
+
+    def __init__(self, verifier: Verifier, max_queued: int = MAX_QUEUED_MESSAGES):
+        self.verifier = verifier
+        verifier.check_codes = False
+        self.max_queued = max_queued
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name="auditor", daemon=True)
+        self.violations = deque(maxlen=RECENT_VIOLATIONS)  # (time, connection_id, is_response, beginning of the message)
+        self.queued = self.verified = self.violation_count = self.dropped = 0
+        self.max_depth = 0
+        self.total_lag = self.max_lag = 0.0
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, connection_id: int, is_response: bool, data: bytes | str):
+        """
+        Called on the forwarding path, so it only queues the message. Past max_queued messages are not verified, and counted as dropped
+        """
+        depth = self.queue.qsize()
+        if depth >= self.max_queued:
+            self.dropped += 1
+            return
+        self.max_depth = max(self.max_depth, depth + 1)
+        self.queued += 1
+        self.queue.put((time.monotonic(), connection_id, is_response, data))
+
+    def run(self):
+        while True:
+            try:
+                task = self.queue.get(timeout=self.verifier.retention.sweep_interval)
+            except queue.Empty:
+                task = ()
+            if task is None:
+                break
+            if task:
+                queued_at, connection_id, is_response, data = task
+                if isinstance(data, str):
+                    data = data.encode("utf-8", "surrogateescape")
+                try:
+                    output = self.verifier.process(connection_id, is_response, data)
+                except Exception as e:  # The thread must outlive a bug in the verification, the message was forwarded anyway
+                    event_log.error("Error verifying a message of connection %s: %r", connection_id, e)
+                    output = b""
+                if output is None:
+                    self.violation_count += 1
+                    self.violations.append((time.time(), connection_id, is_response, preview(data, 200)))
+                lag = time.monotonic() - queued_at
+                self.verified += 1
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag, lag)
+            if self.verifier.sweep():
+                event_log.info("Audit: %s", self.metrics())
+
+    def stop(self):
+        """
+        Verifies the messages still queued, then stops the thread
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+    def metrics(self) -> dict:
+        return {"depth": self.queue.qsize(), "max_depth": self.max_depth, "queued": self.queued, "verified": self.verified,
+                "violations": self.violation_count, "dropped": self.dropped,
+                "average_lag_ms": round(1000 * self.total_lag / max(self.verified, 1), 3), "max_lag_ms": round(1000 * self.max_lag, 3)}
+
+    def dump(self):
+        """
+        Debug command (kill -USR1), as listener.dump_sessions: the metrics and the latest violations. The sessions are
+        not printed, since the thread may be changing them
+        """
+        event_log.flush()
+        log(f"Audit: {self.metrics()}")
+        for violation_time, connection_id, is_response, beginning in self.violations:
+            log(f"\033[1;31m{violation_time:.6f} {connection_id} {'response' if is_response else 'request'}\033[0m {beginning!r}")
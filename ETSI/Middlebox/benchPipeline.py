@@ -0,0 +1,220 @@
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+import jwtParser
+from MessageTypes import *
+from benchSession import invocation, open_pickle, open_sqlite, populate
+from eventLog import event_log, ERROR
+from httpParser import HttpParser
+from replay import ReplayVerifier
+from verifier import fsm
+
+# Micro-benchmarks of the stages of the verification, one at a time: HTTP parsing, JWT verification (with a key minted by
+# localIssuer.py), the schema validation of every message type (with the bodies of PerformanceMeasuring/requests.json and
+# the examples in inputs/, and with a large image, whose string is skipped), the FSM transitions with the generation of the codes, and the session stores.
+# Results are saved as JSON, and compared with a baseline saved by a previous run (--save-baseline) to catch regressions
+
+MIDDLEBOX_DIR = os.path.dirname(os.path.abspath(__file__))
+REQUESTS = os.path.join(MIDDLEBOX_DIR, "../../PerformanceMeasuring/requests.json")
+BASELINE = "benchPipeline-baseline.json"
+LARGE_IMAGE_BYTES = 1024 * 1024
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: 0\r\n\r\n"
+
+
+def measure(function, repeat: int, min_time: float) -> dict:
+    """
+    Microseconds per call: the best and the median of repeat batches, each long enough to take at least min_time seconds
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    times = [t / number * 1e6 for t in timer.repeat(repeat, number)]
+    return {"best_us": min(times), "median_us": statistics.median(times), "calls": number}
+
+
+def request_bytes(url: str, body: bytes, **headers: str) -> bytes:
+    header = "".join(f"{name.replace('_', '-')}: {value}\r\n" for name, value in headers.items())
+    return f"POST {url} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n{header}Content-Length: {len(body)}\r\n\r\n".encode("utf-8") + body
+
+
+def http_benchmarks(bodies: dict[type, bytes]) -> dict:
+    benchmarks = {}
+    for message_type, body in bodies.items():
+        data = request_bytes(message_type.url, body, Authorization="Bearer " + "x" * 900)
+        benchmarks[f"http/request {message_type.__name__}"] = lambda data=data: HttpParser(False).feed(data)
+    split = request_bytes(BuildProductMessageType.url, bodies[BuildProductMessageType])
+    fragments = [split[i:i + 64] for i in range(0, len(split), 64)]
+
+    def feed_fragments():
+        parser = HttpParser(False)
+        for fragment in fragments:
+            parser.feed(fragment)
+
+    benchmarks[f"http/request in {len(fragments)} fragments"] = feed_fragments
+    benchmarks["http/response headers"] = lambda: HttpParser(True, headers_only=True).feed(RESPONSE)
+    return benchmarks
+
+
+def jwt_benchmarks(directory: str) -> dict:
+    try:
+        from localIssuer import LocalIssuer
+    except ImportError as e:
+        log(f"\033[1;33mSkipping the JWT benchmarks: {e}\033[0m")
+        return {}
+    issuer = LocalIssuer("http://localhost:8090", os.path.join(directory, "issuer_key.pem"))
+    jwtParser.signing_keys = jwtParser.SigningKeys(issuer.url, os.path.join(directory, "jwks.dat"), os.path.join(directory, "jwks_info.dat"), offline=True)
+    jwtParser.signing_keys.set_keys(json.dumps(issuer.jwks()).encode("utf-8"))
+    token = issuer.mint("user@example.com")
+    cold, cached = jwtParser.VerifiedTokens(max_size=0), jwtParser.VerifiedTokens()
+
+    def verify(cache: jwtParser.VerifiedTokens):
+        jwtParser.verified_tokens = cache
+        return jwtParser.parse_jwt(token)
+
+    return {"jwt/verify": lambda: verify(cold), "jwt/verify cached": lambda: verify(cached)}
+
+
+def schema_benchmarks(bodies: dict[type, bytes]) -> dict:
+    benchmarks = {}
+    for message_type, body in bodies.items():
+        if len(schema_registry.get(message_type)) == 0:
+            continue
+        if not MessageType.validate_schemas(message_type, body.decode("utf-8")):
+            sys.exit(f"The body of {message_type.__name__} in {REQUESTS} doesn't match its schemas")
+        benchmarks[f"schema/{message_type.__name__}"] = lambda message_type=message_type, body=body: MessageType.validate_schemas(message_type, ParsedRequest("POST", message_type.url, {}, body))
+    by_schema = {filename: message_type for message_type in MessageType.__subclasses__() for filename in message_type.schemas().values()}
+    for filename in sorted(glob.glob(os.path.join(MIDDLEBOX_DIR, "inputs", "*-input.json"))):  # Request bodies, validated by the message type using the schema of the same name
+        name = os.path.basename(filename).removesuffix("-input.json")
+        message_type = by_schema.get(f"schemas/{name}-schema.json")
+        if message_type is None:
+            continue
+        with open(filename, "rb") as f:
+            body = f.read()
+        if not MessageType.validate_schemas(message_type, body.decode("utf-8")):
+            sys.exit(f"{filename} doesn't match the schemas of {message_type.__name__}")
+        benchmarks[f"schema/inputs/{name}"] = lambda message_type=message_type, body=body: MessageType.validate_schemas(message_type, ParsedRequest("POST", message_type.url, {}, body))
+    if ProductImageMessageType in bodies:
+        json_body = json.loads(bodies[ProductImageMessageType])
+        json_body["data"]["image"] = "A" * LARGE_IMAGE_BYTES
+        body = json.dumps(json_body).encode("utf-8")
+        benchmarks["schema/ProductImageMessageType 1 MiB image"] = lambda: ProductImageMessageType.parse_request({}, ParsedRequest("POST", ProductImageMessageType.url, {}, body))
+    return benchmarks
+
+
+def fsm_benchmarks(bodies: dict[type, bytes]) -> dict:
+    """
+    Every transition of the FSM as a request and its 200 response, from the state allowing it: matching, FSM step, new codes
+    and response headers. Schemas and codes are checked too, the codes with X-Testing
+    """
+    benchmarks = {}
+    verifier = ReplayVerifier()
+    user = "user@example.com"
+    pairs = [(state, message_type) for state, transitions in enumerate(fsm.transitions) for message_type in transitions]
+    for state, message_type in pairs:
+        data = request_bytes(message_type.url, bodies.get(message_type, b""), X_User=user, X_Testing="1")
+
+        def step(state=state, data=data):
+            verifier.session.setdefault(user, verifier.retention.new_session(state=0, codes={}))["state"] = state
+            verifier.process(1, False, data)
+            return verifier.process(1, True, RESPONSE)
+
+        if not step():
+            sys.exit(f"{message_type.__name__} was blocked in state {state}")
+        benchmarks[f"fsm/{state} {message_type.__name__}"] = step
+    benchmarks["fsm/next_state"] = lambda: [fsm.next_state(state, message_type) for state, message_type in pairs]
+    return benchmarks
+
+
+def session_benchmarks(directory: str, users: int) -> dict:
+    benchmarks = {}
+    for name, open_store in (("pickle", open_pickle), ("sqlite", open_sqlite)):
+        store_directory = os.path.join(directory, name)
+        os.mkdir(store_directory)
+        populate(open_store, store_directory, users, 20)
+        connection_ids = iter(range(users * 20, sys.maxsize))
+
+        def commit(open_store=open_store, store_directory=store_directory, connection_ids=connection_ids):
+            connection_id = next(connection_ids)
+            invocation(open_store, store_directory, f"user{connection_id % users}@example.com", connection_id)
+
+        benchmarks[f"session/{name} {users} users"] = commit
+    return benchmarks
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Prints the results next to the baseline, returning the benchmarks slower than threshold times their baseline
+    """
+    regressions = []
+    print(f"{'benchmark':55} {'median (us)':>12} {'baseline':>12} {'ratio':>7}")
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:55} {result['median_us']:12.2f} {'-':>12} {'-':>7}")
+            continue
+        ratio = result["median_us"] / baseline[name]["median_us"]
+        color = "\033[1;31m" if ratio > threshold else "\033[32m" if ratio < 1 / threshold else ""
+        print(f"{color}{name:55} {result['median_us']:12.2f} {baseline[name]['median_us']:12.2f} {ratio:7.2f}\033[0m")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the verification stages")
+    parser.add_argument("-k", "--filter", help="Only run the benchmarks whose name contains this", default="")
+    parser.add_argument("-r", "--repeat", help="Batches of each benchmark", type=int, default=5)
+    parser.add_argument("-t", "--min-time", help="Minimum seconds of a batch", type=float, default=0.05)
+    parser.add_argument("-u", "--users", help="Users in the session stores", type=int, default=1000)
+    parser.add_argument("-o", "--output", help="Save the results to this file", default="benchPipeline.json")
+    parser.add_argument("-b", "--baseline", help="Compare with this baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", help="Save the results as the new baseline", action="store_true")
+    parser.add_argument("--threshold", help="Slowdown from the baseline reported as a regression", type=float, default=1.25)
+    parser.add_argument("--schema-backend", help="Validator used for the JSON schemas", choices=SchemaRegistry.BACKENDS, default="codegen")
+    args = parser.parse_args()
+
+    args.output, args.baseline = os.path.abspath(args.output), os.path.abspath(args.baseline)
+    os.chdir(MIDDLEBOX_DIR)  # The schemas are relative to it
+    schema_registry.set_backend(args.schema_backend)
+    if not check_schemas():
+        sys.exit(1)
+    event_log.level = ERROR + 1
+    with open(REQUESTS) as f:
+        bodies = {}
+        for request in json.load(f):
+            message_type = message_router.route(ParsedRequest("POST", "/function/" + request["path"], {}, b""))
+            bodies[message_type] = request["post_data"].replace("{}", "1").encode("utf-8")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        benchmarks = {**http_benchmarks(bodies), **jwt_benchmarks(directory), **schema_benchmarks(bodies), **fsm_benchmarks(bodies), **session_benchmarks(directory, args.users)}
+        for name, function in benchmarks.items():
+            if args.filter in name:
+                results[name] = measure(function, args.repeat, args.min_time)
+
+    report = {"time": time.time(), "python": platform.python_version(), "machine": platform.node(), "schema_backend": args.schema_backend, "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    baseline = {}
+    if os.path.isfile(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.threshold)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved the baseline in {args.baseline}")
+    if len(regressions) > 0:
+        print(f"\033[1;31m{len(regressions)} benchmarks slower than {args.threshold}x the baseline\033[0m")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from MessageTypes import *
+from sessionStore import PickleStore, SqliteStore
+from verifier import Message, SessionRetention
+
+# Cost of one handler invocation (open the store, update one user, commit) for the pickle and sqlite session stores,
+# as the number of users held by the middlebox grows
+
+
+def open_pickle(directory: str) -> PickleStore:
+    return PickleStore(os.path.join(directory, "session.dat"), os.path.join(directory, "waiting.dat"))
+
+
+def open_sqlite(directory: str) -> SqliteStore:
+    return SqliteStore(os.path.join(directory, "session.db"))
+
+
+def populate(open_store, directory: str, users: int, messages: int):
+    store = open_store(directory)
+    retention = SessionRetention()
+    for u in range(users):
+        user_session = retention.new_session(state=0, codes={})
+        for m in range(messages):
+            retention.append(user_session, Message(u * messages + m, ProductsMessageType, True, 200))
+        store.session[f"user{u}@example.com"] = user_session
+    store.commit()
+    store.close()
+
+
+def invocation(open_store, directory: str, user: str, connection_id: int):
+    store = open_store(directory)
+    user_session = store.session[user]
+    message = Message(connection_id, ProductsMessageType, True, 0)
+    store.retention.append(user_session, message)
+    store.connections.add(connection_id, user, message)
+    if isinstance(store, PickleStore):
+        store.commit(waiting=False)
+    else:
+        store.commit()
+    store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-u", "--users", help="Numbers of users to test", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("-m", "--messages", help="Messages in the history of each user", type=int, default=20)
+    parser.add_argument("-n", "--invocations", help="Invocations measured for each configuration", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'users':>8} {'pickle (ms)':>12} {'sqlite (ms)':>12}")
+    for users in args.users:
+        results = []
+        for open_store in (open_pickle, open_sqlite):
+            with tempfile.TemporaryDirectory() as directory:
+                populate(open_store, directory, users, args.messages)
+                start = time.perf_counter()
+                for i in range(args.invocations):
+                    invocation(open_store, directory, f"user{random.randrange(users)}@example.com", users * args.messages + i)
+                results.append((time.perf_counter() - start) / args.invocations * 1000)
+        print(f"{users:>8} {results[0]:>12.3f} {results[1]:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
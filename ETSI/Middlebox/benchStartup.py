@@ -0,0 +1,97 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# Startup cost of randomize.py as a per-message handler, measured with python -X importtime.
+# Fails if the modules imported by the handler take longer than the budget, or if forwarding a response imports a module
+# that only some requests need (JWT verification, jsonschema, debugging output)
+
+MIDDLEBOX_DIR = os.path.dirname(os.path.abspath(__file__))
+HANDLER = os.path.join(MIDDLEBOX_DIR, "randomize.py")
+FORBIDDEN_FOR_RESPONSES = ["jwt", "jsonschema", "requests", "dateutil", "pprint", "cryptography"]
+REQUEST = b'POST /function/init HTTP/1.1\r\nHost: localhost\r\nContent-Length: 2\r\n\r\n{}'
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n"
+
+
+def import_times(stderr: str) -> list[tuple[str, int, int, int]]:
+    """
+    (module, self us, cumulative us, nesting level) for every line of -X importtime output after the site imports
+    """
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        level = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(self_us), int(cumulative_us), level))
+        if name.strip() == "site" and level == 0:
+            modules.clear()
+    return modules
+
+
+def run(args: list[str], cwd: str, input_data: bytes = b"") -> tuple[float, str, int]:
+    start = time.perf_counter()
+    process = subprocess.run(args, cwd=cwd, input=input_data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return (time.perf_counter() - start) * 1000, process.stderr.decode("utf-8", "replace"), process.returncode
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--runs", help="Runs of each measurement", type=int, default=10)
+    parser.add_argument("-b", "--budget", help="Budget in ms for the imports of the handler (median)", type=float, default=30)
+    parser.add_argument("--top", help="Slowest modules to show", type=int, default=10)
+    args = parser.parse_args()
+
+    subprocess.run([sys.executable, "-m", "compileall", "-q", MIDDLEBOX_DIR], check=True)  # As deployed: without bytecode, compiling would dominate
+    floor = statistics.median(run([sys.executable, "-c", "pass"], MIDDLEBOX_DIR)[0] for _ in range(args.runs))
+
+    totals = []
+    modules = []
+    for _ in range(args.runs):
+        _, stderr, _ = run([sys.executable, "-X", "importtime", "-c", "import randomize"], MIDDLEBOX_DIR)
+        modules = import_times(stderr)
+        totals.append(sum(cumulative for _, _, cumulative, level in modules if level == 0) / 1000)
+    imports = statistics.median(totals)
+
+    request_times, response_times = [], []
+    forbidden = set()
+    for i in range(args.runs):
+        with tempfile.TemporaryDirectory() as directory:  # Each time a new session store, where the unauthenticated user can send init
+            os.symlink(os.path.join(MIDDLEBOX_DIR, "schemas"), os.path.join(directory, "schemas"))
+            elapsed, stderr, code = run([sys.executable, HANDLER, str(i), "0", "0"], directory, REQUEST)
+            if code != 0:
+                print(stderr, file=sys.stderr)
+                sys.exit(f"Request {i} was blocked")
+            request_times.append(elapsed)
+            elapsed, stderr, code = run([sys.executable, "-X", "importtime", HANDLER, str(i), "0", "1"], directory, RESPONSE)
+            if code != 0:
+                print(stderr, file=sys.stderr)
+                sys.exit(f"Response {i} was blocked")
+            response_times.append(elapsed)
+            forbidden |= {name for name, _, _, _ in import_times(stderr) if name.split(".")[0] in FORBIDDEN_FOR_RESPONSES}
+
+    print(f"Interpreter startup:           {floor:8.2f} ms")
+    print(f"Handler imports:               {imports:8.2f} ms (budget {args.budget:.2f} ms)")
+    print(f"Request handler (new store):   {statistics.median(request_times):8.2f} ms")
+    print(f"Response handler:              {statistics.median(response_times):8.2f} ms")
+    print("Slowest imports of the handler:")
+    for name, self_us, _, _ in sorted(modules, key=lambda module: -module[1])[:args.top]:
+        print(f"    {name:40} {self_us / 1000:8.2f} ms")
+
+    failed = False
+    if imports > args.budget:
+        print(f"\033[1;31mHandler imports over budget by {imports - args.budget:.2f} ms\033[0m")
+        failed = True
+    if len(forbidden) > 0:
+        print(f"\033[1;31mForwarding a response imported {', '.join(sorted(forbidden))}\033[0m")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from benchPipeline import measure
+
+# Round-trip time between NewMiddlebox/client.py and listener.py, for both transports: HTTP on localhost and the binary frames
+# on the Unix socket, with a new connection for every message (as the handler processes do) and with a connection reused,
+# each with the message sent back or only its verdict. The listener is started with --empty, so only the transport is measured.
+# --processes also times the whole handler process, and --audit starts the listener with --audit instead, to measure what the
+# verification in the background adds to the forwarding
+
+MIDDLEBOX_DIR = os.path.dirname(os.path.abspath(__file__))
+CLIENT = os.path.join(MIDDLEBOX_DIR, "../NewMiddlebox/client.py")
+sys.path.insert(0, os.path.dirname(CLIENT))
+import client
+
+
+def message(size: int) -> bytes:
+    header = f"POST /function/init HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: {size}\r\n\r\n".encode("utf-8")
+    return header + b"x" * size
+
+
+def wait_for(path: str, listener: subprocess.Popen):
+    while not os.path.exists(path):
+        if listener.poll() is not None:
+            sys.exit("The listener exited")
+        time.sleep(0.05)
+
+
+def run_handler(data: bytes, socket_path: str):
+    env = {**os.environ, "MIDDLEBOX_SOCKET": socket_path}
+    result = subprocess.run([sys.executable, CLIENT, "1", "0", "0"], input=data, stdout=subprocess.PIPE, env=env)
+    if result.returncode != 0 or result.stdout != data:
+        sys.exit("The handler failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Round-trip time of the handler to listener transports")
+    parser.add_argument("-s", "--sizes", help="Body sizes of the messages, in bytes", type=int, nargs="+", default=[1024, 65536, 1048576])
+    parser.add_argument("-p", "--port", help="Port of the listener (must be free)", type=int, default=8080)
+    parser.add_argument("-r", "--repeat", help="Batches of each benchmark", type=int, default=5)
+    parser.add_argument("-t", "--min-time", help="Minimum seconds of a batch", type=float, default=0.2)
+    parser.add_argument("--processes", help="Also time a handler process for each transport", action="store_true")
+    parser.add_argument("--audit", help="Start the listener with --audit instead of --empty", action="store_true")
+    parser.add_argument("-o", "--output", help="Save the results to this file", default=None)
+    args = parser.parse_args()
+
+    if args.port != 8080 and args.processes:
+        parser.error("the handler processes only reach the listener on port 8080")
+    with tempfile.TemporaryDirectory() as directory:
+        socket_path = os.path.join(directory, "listener.sock")
+        listener = subprocess.Popen([sys.executable, os.path.join(MIDDLEBOX_DIR, "listener.py"), "--audit" if args.audit else "--empty", "-p", str(args.port), "-u", socket_path], stderr=subprocess.DEVNULL, cwd=MIDDLEBOX_DIR)  # The schemas are relative to it
+        try:
+            wait_for(socket_path, listener)
+            time.sleep(0.2)  # The TCP server is started just before the Unix one
+            results = {}
+            reused = client.FrameConnection(socket_path)
+            for size in args.sizes:
+                data = message(size)
+
+                def unix(verdict_only: bool):
+                    connection = client.FrameConnection(socket_path)
+                    output = connection.verify(1, False, data, verdict_only)
+                    connection.close()
+                    return output
+
+                benchmarks = {}
+                for mode, verdict_only in (("", False), (" verdict-only", True)):
+                    benchmarks["http" + mode] = lambda verdict_only=verdict_only: client.verify_http(1, False, data, args.port, verdict_only)
+                    benchmarks["unix" + mode] = lambda verdict_only=verdict_only: unix(verdict_only)
+                    benchmarks["unix reused" + mode] = lambda verdict_only=verdict_only: reused.verify(1, False, data, verdict_only)
+                if args.processes:
+                    benchmarks["http handler process"] = lambda: run_handler(data, "")
+                    benchmarks["unix handler process"] = lambda: run_handler(data, socket_path)
+                results[size] = {}
+                for name, function in benchmarks.items():
+                    output = function()
+                    if output is not None and b"".join(output) != data:
+                        sys.exit(f"{name} didn't return the message")
+                    results[size][name] = measure(function, args.repeat, args.min_time)
+            reused.close()
+        finally:
+            listener.terminate()
+            listener.wait()
+
+    print(f"{'transport':32} {'body (bytes)':>12} {'median (us)':>12} {'best (us)':>12}")
+    for size, size_results in results.items():
+        for name, result in size_results.items():
+            print(f"{name:32} {size:12} {result['median_us']:12.1f} {result['best_us']:12.1f}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
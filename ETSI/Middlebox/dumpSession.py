@@ -0,0 +1,34 @@
+import argparse
+from pprint import pprint
+from sessionStore import PickleStore, SqliteStore
+
+# Debug command printing the state saved by the handlers, which is no longer dumped to stderr after every message.
+# For listener.py, whose state is in memory, send SIGUSR1 instead (kill -USR1 <pid>)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the sessions saved by randomize.py, forkServer.py or mb.py")
+    parser.add_argument("--store", help="Session store of the handler", choices=["sqlite", "pickle"], default="sqlite")
+    parser.add_argument("-f", "--file", help="Session file (default session.db for sqlite, session.dat for pickle)", default=None)
+    parser.add_argument("-u", "--user", help="Only print the session of this user", default=None)
+    parser.add_argument("--waiting", help="Also print the partial bodies", action="store_true")
+    args = parser.parse_args()
+
+    if args.store == "sqlite":
+        store = SqliteStore(args.file or "session.db")
+    else:
+        store = PickleStore(args.file or "session.dat", "waiting.dat" if args.waiting else None)
+    try:
+        if args.user is not None:
+            pprint({args.user: store.session[args.user]} if args.user in store.session else {})
+        else:
+            pprint(dict(store.session.items()))  # Users locked by a handler at this moment are skipped
+        print(f"Pending requests: {len(store.connections)}")
+        if args.waiting:
+            pprint({key: parser.buffer for key, parser in store.waiting_bodies.items()})
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import atexit
+import os
+import sys
+import threading
+import time
+from collections import deque
+from httpParser import preview
+
+# Leveled logging of the verification, kept off the latency of the messages: a line is only formatted if its level is enabled,
+# payloads are truncated, the lines of allowed messages can be sampled, and lines are written in batches by a sink instead
+# of one write per line. By default every message gets one compact verdict line; payloads, codes and the other details of
+# the verification are at debug level. Configured with MIDDLEBOX_LOG_LEVEL (debug, info, warning, error),
+# MIDDLEBOX_LOG_SAMPLE (fraction of the info and debug lines kept, warnings and errors are always kept) and
+# MIDDLEBOX_LOG_PAYLOAD_BYTES (bytes of a payload shown at debug level)
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+COLORS = {DEBUG: "\033[2m", INFO: "", WARNING: "\033[1;33m", ERROR: "\033[1;31m"}
+
+LOG_LEVEL = LEVELS.get(os.environ.get("MIDDLEBOX_LOG_LEVEL", "info").lower(), INFO)
+LOG_SAMPLE = float(os.environ.get("MIDDLEBOX_LOG_SAMPLE", "1"))
+LOG_PAYLOAD_BYTES = int(os.environ.get("MIDDLEBOX_LOG_PAYLOAD_BYTES", "256"))
+
+ALLOW, PASS, DROP, BLOCK = "allow", "pass", "drop", "block"  # PASS: forwarded without verification
+VERDICT_LEVELS = {ALLOW: INFO, PASS: INFO, DROP: WARNING, BLOCK: WARNING}
+
+
+class Payload:
+    """
+    Message bytes to be logged, truncated only when the line is actually formatted
+    """
+    __slots__ = ("data",)
+
+    def __init__(self, data: bytes | bytearray | memoryview | str):
+        self.data = data
+
+    def __str__(self):
+        if isinstance(self.data, str):
+            return self.data if len(self.data) <= LOG_PAYLOAD_BYTES else self.data[:LOG_PAYLOAD_BYTES] + f"... ({len(self.data) - LOG_PAYLOAD_BYTES} more characters)"
+        return preview(self.data, LOG_PAYLOAD_BYTES)
+
+
+class BufferedSink:
+    """
+    Lines kept in memory and written together when flush() is called, when max_lines are waiting, and at exit.
+    Without a file, lines go to the sys.stderr of the moment they are written (forkServer.py replaces it in every child)
+    """
+
+    def __init__(self, file=None, max_lines: int = 256):
+        self.file = file
+        self.max_lines = max_lines
+        self.lines = []
+
+    def write(self, line: str):
+        self.lines.append(line)
+        if len(self.lines) >= self.max_lines:
+            self.flush()
+
+    def flush(self):
+        if len(self.lines) == 0:
+            return
+        lines, self.lines = self.lines, []
+        file = sys.stderr if self.file is None else self.file
+        file.write("\n".join(lines) + "\n")
+        file.flush()
+
+    def close(self):
+        self.flush()
+
+
+class AsyncSink(BufferedSink):
+    """
+    Lines written by a background thread, at most interval seconds after being logged, so that a long-running process
+    (listener.py) never waits on stderr while verifying a message
+    """
+
+    def __init__(self, file=None, max_lines: int = 256, interval: float = 0.2):
+        super().__init__(file, max_lines)
+        self.interval = interval
+        self.lines = deque()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="log-sink", daemon=True)
+        self.thread.start()
+
+    def write(self, line: str):
+        self.lines.append(line)
+        if len(self.lines) >= self.max_lines:
+            self.wake.set()
+
+    def flush(self):
+        with self.lock:
+            lines = []
+            while len(self.lines) > 0:
+                lines.append(self.lines.popleft())
+            if len(lines) > 0:
+                file = sys.stderr if self.file is None else self.file
+                file.write("\n".join(lines) + "\n")
+                file.flush()
+
+    def run(self):
+        while not self.closed:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self.flush()
+
+    def close(self):
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+
+
+class EventLog:
+    def __init__(self, level: int = LOG_LEVEL, sample: float = LOG_SAMPLE, sink: BufferedSink | None = None):
+        self.level = level
+        self.sample = sample
+        self.sink = BufferedSink() if sink is None else sink
+
+    def set_sink(self, sink: BufferedSink):
+        self.sink.close()
+        self.sink = sink
+
+    def enabled(self, level: int) -> bool:
+        if level < self.level:
+            return False
+        return level >= WARNING or self.sample >= 1 or int.from_bytes(os.urandom(2), "big") < self.sample * 65536
+
+    def log(self, level: int, message: str, *args):
+        """
+        message is formatted with % and args only if the line is kept
+        """
+        if not self.enabled(level):
+            return
+        if len(args) > 0:
+            message = message % args
+        color = COLORS[level]
+        self.sink.write(f"{color}{message}\033[0m" if color else message)
+
+    def debug(self, message: str, *args):
+        self.log(DEBUG, message, *args)
+
+    def info(self, message: str, *args):
+        self.log(INFO, message, *args)
+
+    def warning(self, message: str, *args):
+        self.log(WARNING, message, *args)
+
+    def error(self, message: str, *args):
+        self.log(ERROR, message, *args)
+
+    def verdict(self, connection_id: int, is_response: bool, verdict: str, user: str | None, message_type: type | None, reason: str = ""):
+        """
+        The line logged for every message: time, connection, direction, verdict, user, message type and why it was not allowed
+        """
+        self.log(VERDICT_LEVELS[verdict], "%.6f %s %s %-5s %s %s%s", time.time(), connection_id, "response" if is_response else "request ", verdict, "-" if user is None else user,
+                 "-" if message_type is None else message_type.__name__, f" ({reason})" if reason else "")
+
+    def flush(self):
+        self.sink.flush()
+
+
+event_log = EventLog()
+atexit.register(lambda: event_log.sink.close())
@@ -0,0 +1,112 @@
+import argparse
+import os
+import signal
+import socket
+import sys
+import traceback
+import randomize
+from eventLog import event_log
+from MessageTypes import *
+from jwtParser import signing_keys
+from verifier import fsm
+
+# Keeps the per-message contract of randomize.py (a process for each message, with the message on stdin and the output on
+# stdout) without paying for a new interpreter and its imports every time. The modules, the schemas, the compiled FSM and the
+# signing keys are loaded once; then for every message NewMiddlebox/launcher passes its stdin, stdout and stderr and its argv
+# (connection_id splice_id is_response) on a Unix socket, and a forked child runs randomize.main() on them, answering with
+# the exit status. The stage markers of listener.py are written to the stderr of the fork server
+
+FORK_SERVER_SOCKET = os.environ.get("FORK_SERVER_SOCKET", "/tmp/middlebox-fork.sock")
+
+
+def prewarm():
+    schema_registry.set_backend(randomize.SCHEMA_BACKEND)
+    if not check_schemas():
+        sys.exit(1)
+    fsm.code_headers
+    try:
+        signing_keys.load()
+        import jwt.api_jwt  # Not used here: imported before forking so that the handlers verifying tokens don't import it again
+    except Exception as e:
+        log(f"\033[1;33mCouldn't load the signing keys, every handler will load them again: {e}\033[0m")
+
+
+def reap(*_):
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0] != 0:
+            pass
+    except ChildProcessError:
+        pass
+
+
+def run_child(fds: list[int], argv: list[str], timings) -> int:
+    for target, fd in enumerate(fds):
+        os.dup2(fd, target)
+        os.close(fd)
+    sys.stdin, sys.stdout, sys.stderr = os.fdopen(0, "r", closefd=False), os.fdopen(1, "w", closefd=False), os.fdopen(2, "w", closefd=False)
+    sys.argv = ["randomize.py"] + argv
+    try:
+        randomize.main(timings)
+        code = 0
+    except SystemExit as e:
+        code = 0 if e.code is None else e.code if isinstance(e.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        code = 1
+    event_log.flush()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return code
+
+
+def serve(path: str):
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(128)
+    signal.signal(signal.SIGCHLD, reap)
+    timings = os.fdopen(os.dup(sys.stderr.fileno()), "w")
+    log(f"Fork server listening on {path}...")
+    while True:
+        connection, _ = server.accept()
+        try:
+            data, fds, _, _ = socket.recv_fds(connection, 1024, 3)
+        except OSError as e:
+            log(f"Invalid launcher request: {e}")
+            connection.close()
+            continue
+        argv = data.decode().split()
+        if len(fds) != 3 or len(argv) != 3:
+            log(f"Invalid launcher request: {argv}, {len(fds)} file descriptors")
+            for fd in fds:
+                os.close(fd)
+            connection.close()
+            continue
+        timings.flush()
+        event_log.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            server.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            code = run_child(fds, argv, timings)
+            try:
+                connection.sendall(f"{code}\n".encode())
+            finally:
+                os._exit(code)
+        for fd in fds:
+            os.close(fd)
+        connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-warmed fork server for the per-message TLMSP middlebox handler")
+    parser.add_argument("-s", "--socket", help="Unix socket to listen on", default=FORK_SERVER_SOCKET)
+    args = parser.parse_args()
+    prewarm()
+    serve(args.socket)
+
+
+if __name__ == "__main__":
+    main()
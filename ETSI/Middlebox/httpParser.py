@@ -0,0 +1,218 @@
+import os
+import re
+
+# Incremental HTTP/1.1 parsing of the messages of a connection, which TLMSP may deliver split over several containers.
+# A parser keeps the bytes received so far and is fed each fragment, returning the messages completed by it
+
+REQUEST_LINE = re.compile(rb"(GET|POST|HEAD|PUT|DELETE) ([^ ]+) HTTP/(\d+(?:\.\d+)?)")
+STATUS_LINE = re.compile(rb"HTTP/(\d+(?:\.\d+)?) (\d+)")
+LOG_PREVIEW_BYTES = 2048
+MAX_BODY_BYTES = int(os.environ.get("MIDDLEBOX_MAX_BODY_BYTES", 32 * 1024 * 1024))  # 0 for no limit
+
+
+class InvalidMessage(ValueError):
+    pass
+
+
+def preview(data: bytes | bytearray | memoryview, limit: int = LOG_PREVIEW_BYTES) -> str:
+    """
+    The beginning of data decoded for the logs, so that a large body is never decoded as a whole
+    """
+    if len(data) <= limit:
+        return str(data, "utf-8", "replace")
+    return str(data[:limit], "utf-8", "replace") + f"... ({len(data) - limit} more bytes)"
+
+
+class HttpMessage:
+    """
+    A complete message: start (the groups of the request or status line), the title-cased headers, the body (without the chunked
+    framing) and raw, the exact bytes received, to be forwarded. Body and raw share the received buffer when possible, so they
+    are bytes-like objects (bytes, bytearray or memoryview) that must not be modified
+    """
+    __slots__ = ("start", "headers", "body", "raw")
+
+    def __init__(self, start: tuple, headers: dict[str, str], body: bytes | memoryview, raw: bytes | bytearray):
+        self.start = start
+        self.headers = headers
+        self.body = body
+        self.raw = raw
+
+    def __repr__(self):
+        return f"(start={self.start}, headers={self.headers}, body={len(self.body)} bytes)"
+
+
+class HttpParser:
+    """
+    Parser of one direction of a connection. Received bytes are appended to a single buffer and scanning resumes where it stopped,
+    so reassembling a message costs linear time in its size however many fragments it arrives in.
+    The body is framed by Content-Length or chunked transfer encoding; without either, a request has no body
+    (RFC 7230 3.3.3) and the body of a response is whatever arrived with the header.
+    With headers_only the body is never waited for, as for the responses seen by the handlers of the header context.
+    A connection kept alive carries several messages, possibly pipelined in the same fragment, each returned on its own.
+    A message can also be released as soon as its header is complete, the rest of its body then only being counted.
+    A body over max_body bytes is rejected as soon as its length is known, before it is received
+    """
+    max_body = MAX_BODY_BYTES
+
+    def __init__(self, is_response: bool, headers_only: bool = False):
+        self.is_response = is_response
+        self.headers_only = headers_only
+        self.buffer = bytearray()
+        self.pos = 0  # Offset in buffer up to which the current message has been parsed
+        self.start = None  # Set once the header of the current message is complete
+        self.headers = None
+        self.body = None
+        self.content_length = None
+        self.chunk_remaining = None  # None while reading a chunk size line, -1 while reading the trailer
+        self.passthrough = 0  # Bytes still to come of the body of a released message
+        self.passthrough_blocked = False  # Whether the released message was blocked, and so its body must be too
+
+    def __len__(self):
+        """
+        Bytes received and not yet part of a complete message
+        """
+        return len(self.buffer)
+
+    def pass_body(self, data: bytes) -> bytes:
+        """
+        The beginning of data that belongs to the body of a released message, to be forwarded as it is; the rest must be fed
+        """
+        if self.passthrough == 0:
+            return b""
+        passed = data[:self.passthrough]
+        self.passthrough -= len(passed)
+        return passed
+
+    def release(self) -> HttpMessage | None:
+        """
+        For a message whose header is complete and whose body, framed by Content-Length, is still being received: the message
+        as received so far, with the body not yet complete. The rest of the body is then returned by pass_body without being buffered
+        """
+        if self.start is None or self.content_length is None:
+            return None
+        received = len(self.buffer) - self.pos
+        raw = self.buffer
+        message = HttpMessage(self.start, self.headers, memoryview(raw)[self.pos:], raw)
+        self.passthrough = self.content_length - received
+        self.passthrough_blocked = False
+        self.buffer = bytearray()
+        self.pos = 0
+        self.start = self.headers = self.body = self.content_length = self.chunk_remaining = None
+        return message
+
+    def feed(self, data: bytes) -> list[HttpMessage]:
+        self.buffer += data
+        messages = []
+        while len(self.buffer) > 0 and (message := self.parse()) is not None:
+            messages.append(message)
+        return messages
+
+    def parse(self) -> HttpMessage | None:
+        if self.start is None and not self.parse_header():
+            return None
+        body_start = self.pos
+        if self.content_length is not None:
+            if len(self.buffer) - self.pos < self.content_length:
+                return None
+            self.pos += self.content_length
+        elif self.body is not None and not self.parse_chunks():
+            return None
+        elif self.body is None:
+            self.pos = len(self.buffer)
+        if self.pos == len(self.buffer):  # The usual case: the message is the whole buffer, handed over without copying it
+            raw = self.buffer
+            self.buffer = bytearray()
+        else:
+            raw = bytes(self.buffer[:self.pos])
+            del self.buffer[:self.pos]
+        body = memoryview(raw)[body_start:self.pos] if self.body is None else bytes(self.body)
+        message = HttpMessage(self.start, self.headers, body, raw)
+        self.pos = 0
+        self.start = self.headers = self.body = self.content_length = self.chunk_remaining = None
+        return message
+
+    def parse_header(self) -> bool:
+        end = self.buffer.find(b"\r\n\r\n", max(self.pos - 3, 0))
+        if end == -1:
+            self.pos = len(self.buffer)
+            return False
+        lines = bytes(self.buffer[:end]).decode("utf-8", "surrogateescape").split("\r\n")
+        match = (STATUS_LINE if self.is_response else REQUEST_LINE).match(lines[0].encode("utf-8", "surrogateescape"))
+        if not match:
+            raise InvalidMessage("Invalid response" if self.is_response else "Invalid request")
+        headers = {}
+        for line in lines[1:]:
+            if ":" not in line:
+                raise InvalidMessage(f"Invalid header line {line!r}")
+            name, value = line.split(":", 1)
+            headers[name.strip().title()] = value.strip()
+        self.start = tuple(group.decode("utf-8", "surrogateescape") for group in match.groups())
+        self.headers = headers
+        self.pos = end + 4
+        if self.is_response and (self.start[1].startswith("1") or self.start[1] in ("204", "304")):
+            self.content_length = 0
+        elif self.headers_only:
+            self.frame_received_body()
+        elif "chunked" in headers.get("Transfer-Encoding", "").lower():
+            self.body = bytearray()
+        elif "Content-Length" in headers:
+            self.content_length = self.parse_content_length()
+            self.check_body_size(self.content_length)
+        elif not self.is_response:  # Otherwise the requests pipelined after it would be taken as its body, and never verified
+            self.content_length = 0
+        return True
+
+    def parse_content_length(self) -> int:
+        try:
+            content_length = int(self.headers["Content-Length"])
+        except ValueError:
+            raise InvalidMessage(f"Invalid Content-Length {self.headers['Content-Length']}")
+        if content_length < 0:
+            raise InvalidMessage(f"Invalid Content-Length {self.headers['Content-Length']}")
+        return content_length
+
+    def check_body_size(self, size: int):
+        if self.max_body and size > self.max_body:
+            raise InvalidMessage(f"Body of {size} bytes over the limit of {self.max_body}")
+
+    def frame_received_body(self):
+        """
+        For headers_only: the body is still delimited by Content-Length when it has arrived whole, so that the next pipelined
+        message of the connection starts right after it. Otherwise the message ends with the bytes received
+        """
+        if "Content-Length" in self.headers and "chunked" not in self.headers.get("Transfer-Encoding", "").lower():
+            content_length = self.parse_content_length()
+            if len(self.buffer) - self.pos >= content_length:
+                self.content_length = content_length
+
+    def parse_chunks(self) -> bool:
+        """
+        Appends the complete chunks to body, returns whether the last chunk and the trailer have been received
+        """
+        while True:
+            if self.chunk_remaining is None:
+                end = self.buffer.find(b"\r\n", self.pos)
+                if end == -1:
+                    return False
+                try:
+                    size = int(bytes(self.buffer[self.pos:end]).split(b";", 1)[0], 16)
+                except ValueError:
+                    raise InvalidMessage("Invalid chunk size")
+                self.check_body_size(len(self.body) + size)
+                self.pos = end + 2
+                self.chunk_remaining = size if size > 0 else -1
+            elif self.chunk_remaining == -1:
+                if self.buffer[self.pos:self.pos + 2] == b"\r\n":
+                    self.pos += 2
+                    return True
+                end = self.buffer.find(b"\r\n\r\n", self.pos)
+                if end == -1:
+                    return False
+                self.pos = end + 4
+                return True
+            else:
+                if len(self.buffer) - self.pos < self.chunk_remaining + 2:
+                    return False
+                self.body += self.buffer[self.pos:self.pos + self.chunk_remaining]
+                self.pos += self.chunk_remaining + 2
+                self.chunk_remaining = None
@@ -1,51 +1,204 @@
+import json
 import os
 import pickle
 import sys
+import threading
 import time
-import pathlib
-from dateutil import parser
-import jwt
-import requests
+from collections import OrderedDict
 
-oidc_server = "accounts.google.com"
-jwks_file = "jwks.dat"
-jwks_info_file = "jwks_info.dat"
+# The JWKS of the issuer is cached in jwks_file, and only loaded when the first token is verified (jwt itself is only imported then).
+# The issuer can be changed with OIDC_ISSUER (e.g. a localIssuer.py instance for tests), and with OIDC_OFFLINE=1 the keys
+# in jwks_file are always used as they are, without ever contacting the issuer
+oidc_issuer = os.environ.get("OIDC_ISSUER", "https://accounts.google.com")
+jwks_file = os.environ.get("OIDC_JWKS_FILE", "jwks.dat")
+jwks_info_file = os.environ.get("OIDC_JWKS_INFO_FILE", "jwks_info.dat")
+offline = os.environ.get("OIDC_OFFLINE", "0") == "1"
+JWKS_DEFAULT_LIFETIME_SECONDS = 3600  # If the issuer doesn't send an Expires header
+JWKS_REFRESH_MARGIN_SECONDS = 300
+JWT_CACHE_SIZE = 1024
 
 
 def log(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
-reload_jwks = True
-if os.path.isfile(jwks_file) and os.path.isfile(jwks_info_file):
-    try:
-        (signing_algos, expiration) = pickle.load(open(jwks_info_file, "rb"))
-        if expiration > time.time():
-            reload_jwks = False
-    except pickle.UnpicklingError:
-        pass
-if reload_jwks:
-    log("Reloading jwks")
-    oidc_config = requests.get(f"https://{oidc_server}/.well-known/openid-configuration").json()
-    signing_algos = oidc_config["id_token_signing_alg_values_supported"]
-    jwks_uri = oidc_config["jwks_uri"]
-    r = requests.get(jwks_uri)
-    expires = parser.parse(r.headers.get("expires")).timestamp()
-    with open(jwks_file, "wb") as f:
-        f.write(r.content)
-    pickle.dump((signing_algos, expires), open(jwks_info_file, "wb"))
-
-jwks_uri = pathlib.Path(os.path.abspath(jwks_file)).as_uri()
-jwks_client = jwt.PyJWKClient(jwks_uri)
+class SigningKeys:
+    """
+    Signing keys of the JWKS by kid, loaded from jwks_file when first needed and fetched from the issuer only when expired.
+    If the issuer can't be reached the expired keys are used anyway. An unknown kid fetches the JWKS again, in case the issuer
+    rotated its keys, unless the keys are refreshed in the background, in which case no verification ever waits for the issuer
+    """
+
+    def __init__(self, issuer: str = oidc_issuer, jwks_file: str = jwks_file, jwks_info_file: str = jwks_info_file, offline: bool = offline):
+        self.issuer = issuer
+        self.jwks_file = jwks_file
+        self.jwks_info_file = jwks_info_file
+        self.offline = offline
+        self.keys = None
+        self.signing_algos = ["RS256"]
+        self.expires = 0
+        self.lock = threading.Lock()
+        self.refresher = None
+        self.refresh_requested = threading.Event()
+
+    def load(self):
+        import jwt
+        with self.lock:
+            if self.keys is not None:
+                return
+            if os.path.isfile(self.jwks_file):
+                try:
+                    if os.path.isfile(self.jwks_info_file):
+                        (self.signing_algos, self.expires) = pickle.load(open(self.jwks_info_file, "rb"))
+                    self.set_keys(open(self.jwks_file, "rb").read())
+                except (pickle.UnpicklingError, EOFError, ValueError, jwt.PyJWTError) as e:
+                    log(f"Invalid cached jwks: {e}")
+                    self.expires = 0
+            if self.offline:
+                if self.keys is None:
+                    raise jwt.PyJWKClientError(f"No jwks in {self.jwks_file} for offline verification")
+            elif self.expires <= time.time() and (self.refresher is None or self.keys is None):
+                self.fetch()
+
+    def set_keys(self, content: bytes):
+        import jwt
+        jwk_set = jwt.PyJWKSet.from_dict(json.loads(content))
+        self.keys = {key.key_id: key.key for key in jwk_set.keys if key.key_id is not None}
+
+    def fetch(self):
+        """
+        Downloads the JWKS from the issuer and saves it in jwks_file. Failures are only logged while there are keys to use
+        """
+        import jwt
+        import urllib.request
+        from email.utils import parsedate_to_datetime
+        log("Reloading jwks")
+        try:
+            with urllib.request.urlopen(f"{self.issuer}/.well-known/openid-configuration", timeout=10) as r:
+                oidc_config = json.load(r)
+            with urllib.request.urlopen(oidc_config["jwks_uri"], timeout=10) as r:
+                content = r.read()
+                expires = r.headers.get("Expires")
+            self.set_keys(content)
+        except (OSError, ValueError, KeyError, jwt.PyJWTError) as e:
+            if self.keys is None:
+                raise jwt.PyJWKClientError(f"Couldn't fetch the jwks from {self.issuer}: {e}")
+            log(f"\033[1;33mCouldn't fetch the jwks from {self.issuer}, using the expired keys: {e}\033[0m")
+            return
+        self.signing_algos = oidc_config.get("id_token_signing_alg_values_supported", self.signing_algos)
+        try:
+            self.expires = parsedate_to_datetime(expires).timestamp()
+        except (TypeError, ValueError):
+            self.expires = time.time() + JWKS_DEFAULT_LIFETIME_SECONDS
+        with open(self.jwks_file, "wb") as f:
+            f.write(content)
+        pickle.dump((self.signing_algos, self.expires), open(self.jwks_info_file, "wb"))
+
+    def refresh_in_background(self, margin: float = JWKS_REFRESH_MARGIN_SECONDS):
+        """
+        For long-running processes: a daemon thread fetches the JWKS margin seconds before it expires, or when an unknown kid is seen
+        """
+        import jwt
+        if self.offline or self.refresher is not None:
+            return
+
+        def refresh():
+            while True:
+                self.refresh_requested.wait(max(self.expires - margin - time.time(), 0))
+                self.refresh_requested.clear()
+                try:
+                    self.fetch()
+                except jwt.PyJWKClientError as e:
+                    log(f"\033[1;33m{e}\033[0m")
+                if self.expires - margin <= time.time():  # Fetch failed, or the issuer sent an already expiring JWKS
+                    time.sleep(min(margin, 60))
+
+        self.refresher = threading.Thread(target=refresh, name="jwks-refresh", daemon=True)
+        try:
+            self.load()
+        except jwt.PyJWKClientError as e:
+            log(f"\033[1;33m{e}\033[0m")
+        self.refresher.start()
+
+    def get(self, id_token: str):
+        import jwt
+        self.load()
+        kid = jwt.get_unverified_header(id_token).get("kid")
+        if kid not in self.keys:
+            if self.refresher is not None:
+                self.refresh_requested.set()
+            elif not self.offline:
+                self.fetch()
+            if kid not in self.keys:
+                raise jwt.PyJWKClientError(f"Unable to find a signing key that matches: {kid}")
+        return self.keys[kid]
+
+
+class VerifiedTokens:
+    """
+    LRU cache of the claims of the tokens already verified, keyed by the digest of the token and kept until the token expires.
+    Tokens failing verification are never cached, so they are verified (and rejected) again every time
+    """
+
+    def __init__(self, max_size: int = JWT_CACHE_SIZE):
+        self.max_size = max_size
+        self.claims = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(id_token: str) -> bytes:
+        import hashlib
+        return hashlib.sha256(id_token.encode("utf-8")).digest()
+
+    def get(self, id_token: str) -> dict | None:
+        digest = self.digest(id_token)
+        entry = self.claims.get(digest)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                del self.claims[digest]
+            self.misses += 1
+            return None
+        self.claims.move_to_end(digest)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, id_token: str, data: dict):
+        if "exp" not in data:  # Without an expiration there is no safe time to keep the claims until
+            return
+        self.claims[self.digest(id_token)] = (data["exp"], data)
+        if len(self.claims) > self.max_size:
+            self.claims.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "cached_tokens": len(self.claims)}
+
+
+signing_keys = SigningKeys()
+verified_tokens = VerifiedTokens()
 
 
 def parse_jwt(id_token: str) -> dict:
-    signing_key = jwks_client.get_signing_key_from_jwt(id_token)
+    data = verified_tokens.get(id_token)
+    if data is not None:
+        return data
+    import jwt
+    key = signing_keys.get(id_token)
     data = jwt.api_jwt.decode(
         id_token,
-        key=signing_key.key,
-        algorithms=signing_algos,
-        issuer="https://accounts.google.com",
+        key=key,
+        algorithms=signing_keys.signing_algos,
+        issuer=signing_keys.issuer,
         options={"verify_aud": False}
     )
+    verified_tokens.put(id_token, data)
     return data
+
+
+def unverified_claims(id_token: str) -> dict:
+    """
+    The claims of the token without verifying its signature, only to route it to the process that verifies it
+    """
+    import base64
+    payload = id_token.split(".")[1]
+    return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
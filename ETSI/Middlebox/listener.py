@@ -0,0 +1,261 @@
+import argparse
+import asyncio
+import json
+import os
+import signal
+import struct
+from MessageTypes import *
+from auditor import Auditor
+from eventLog import event_log, AsyncSink
+from jwtParser import signing_keys, verified_tokens
+from sessionStore import PickleStore
+from verifier import Verifier, plog, timing, MAX_MESSAGES_PER_USER, SESSION_IDLE_SECONDS
+from workerPool import WorkerPool
+
+# Long-running replacement for randomize.py: the FSM, the sessions and the partial bodies stay in memory, and each message
+# is received with the same {"connection_id", "is_response", "data"} -> {"success", "data"} protocol of NewMiddlebox/listener.go
+
+REQUEST_FRAME = struct.Struct("!QBI")  # connection_id, flags, length of the message that follows
+REPLY_FRAME = struct.Struct("!BI")  # status, length of the data to forward (or of the insertion) that follows
+INSERTION = struct.Struct("!I")  # Offset in the message of the inserted bytes that follow
+RESPONSE_FLAG, VERDICT_ONLY_FLAG = 1, 2
+FORWARD, BLOCKED, INSERT = 0, 1, 2
+
+
+def insertion(data: bytes, output: bytes) -> tuple[int, bytes] | None:
+    """
+    (offset, inserted) if output is data with inserted at offset (empty if output is data), None otherwise.
+    The offset is searched from the start, so it is found quickly for the codes added at the end of the header block
+    """
+    extra = len(output) - len(data)
+    if extra < 0:
+        return None
+    if extra == 0:
+        return (0, b"") if output == data else None
+    offset = 0
+    while offset + 256 <= len(data) and output[offset:offset + 256] == data[offset:offset + 256]:
+        offset += 256
+    while offset < len(data) and output[offset] == data[offset]:
+        offset += 1
+    if output[offset + extra:] != data[offset:]:
+        return None
+    return offset, bytes(output[offset:offset + extra])
+
+
+class Listener:
+    """
+    Messages are received either as JSON ({"connection_id", "is_response", "data"} -> {"success", "data"}), or with
+    Content-Type application/octet-stream as the raw message bytes, with the connection in the X-Connection-Id and X-Is-Response
+    headers, and answered with the bytes to forward (403 if blocked), so that a message is never decoded or re-encoded as a whole.
+    On the Unix socket (--unix) the same is done with binary frames, REQUEST_FRAME followed by the message and REPLY_FRAME
+    followed by the data to forward, many on the same connection.
+    In verdict-only mode (VERDICT_ONLY_FLAG, or the X-Verdict-Only: 1 header) the data to forward is not sent back when it is
+    the message with some bytes inserted (nothing for a request, the codes for a response), only the insertion
+    (INSERT followed by INSERTION and the bytes, or 200 with X-Insert-At and the bytes), so that the traffic doesn't grow with the body.
+    With a pool, the messages are verified by its worker processes instead of the verifier, with an auditor they are forwarded
+    at once and verified later by its thread, and without any of them they are forwarded as they are, to measure the transport alone
+    """
+
+    def __init__(self, verifier: Verifier | None, pool: WorkerPool | None = None, auditor: Auditor | None = None):
+        self.verifier = verifier
+        self.pool = pool
+        self.auditor = auditor
+
+    async def verify(self, connection_id: int, is_response: bool, data: bytes | str) -> bytes | None:
+        timing(connection_id, is_response, "Listener started")
+        if self.auditor is not None:
+            self.auditor.submit(connection_id, is_response, data)
+        if self.pool is not None:
+            return await self.pool.process(connection_id, is_response, data)  # The workers write the stage markers
+        if self.verifier is None or self.auditor is not None:
+            return data.encode("utf-8", "surrogateescape") if isinstance(data, str) else data
+        stage = "processResponse" if is_response else "processRequest"
+        timing(connection_id, is_response, stage + " started")
+        output = self.verifier.process(connection_id, is_response, data)
+        timing(connection_id, is_response, stage + " finished")
+        return output
+
+    async def handle(self, params: dict) -> dict:
+        connection_id = int(params["connection_id"])
+        is_response = bool(params["is_response"])
+        output = await self.verify(connection_id, is_response, params["data"])
+        if output is None:
+            out = {"success": False}
+        else:
+            out = {"success": True, "data": str(output, "utf-8", "surrogateescape")}
+        timing(connection_id, is_response, "Listener finished")
+        return out
+
+    async def handle_raw(self, headers: dict[str, str], body: bytes) -> (str, dict[str, str], bytes):
+        connection_id = int(headers["X-Connection-Id"])
+        is_response = headers.get("X-Is-Response", "0") == "1"
+        output = await self.verify(connection_id, is_response, body)
+        timing(connection_id, is_response, "Listener finished")
+        if output is None:
+            return "403 Forbidden", {}, b""
+        if headers.get("X-Verdict-Only") == "1" and (inserted := insertion(body, output)) is not None:
+            return "200 OK", {"X-Insert-At": str(inserted[0])}, inserted[1]
+        return "200 OK", {}, output
+
+    async def serve_frames(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    connection_id, flags, length = REQUEST_FRAME.unpack(await reader.readexactly(REQUEST_FRAME.size))
+                    data = await reader.readexactly(length)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                is_response = bool(flags & RESPONSE_FLAG)
+                output = await self.verify(connection_id, is_response, data)
+                timing(connection_id, is_response, "Listener finished")
+                if output is None:
+                    writer.write(REPLY_FRAME.pack(BLOCKED, 0))
+                elif flags & VERDICT_ONLY_FLAG and (inserted := insertion(data, output)) is not None:
+                    writer.write(REPLY_FRAME.pack(INSERT, INSERTION.size + len(inserted[1])) + INSERTION.pack(inserted[0]))
+                    writer.write(inserted[1])
+                else:
+                    writer.write(REPLY_FRAME.pack(FORWARD, len(output)))
+                    writer.write(output)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    header = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                lines = header.decode("latin-1").split("\r\n")
+                headers = {line.split(":", 1)[0].strip().title(): line.split(":", 1)[1].strip() for line in lines[1:] if ":" in line}
+                body = await reader.readexactly(int(headers.get("Content-Length", 0)))
+                content_type = "application/json"
+                extra_headers = {}
+                try:
+                    if headers.get("Content-Type") == "application/octet-stream":
+                        status, extra_headers, out = await self.handle_raw(headers, body)
+                        content_type = "application/octet-stream"
+                    else:
+                        out = json.dumps(await self.handle(json.loads(body))).encode()
+                        status = "200 OK"
+                except (json.decoder.JSONDecodeError, KeyError, ValueError) as e:
+                    event_log.warning("Error decoding request: %s", e)
+                    out = b""
+                    status = "400 Bad Request"
+                keep_alive = headers.get("Connection", "").lower() != "close" and lines[0].endswith("HTTP/1.1")
+                response = f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(out)}\r\n"
+                response += "".join(f"{name}: {value}\r\n" for name, value in extra_headers.items())
+                if not keep_alive:
+                    response += "Connection: close\r\n"
+                writer.write(response.encode() + b"\r\n")
+                writer.write(out)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        finally:
+            writer.close()
+
+
+async def sweep_periodically(verifier: Verifier):
+    while True:
+        await asyncio.sleep(verifier.retention.sweep_interval)
+        if verifier.sweep():
+            event_log.info("JWT cache: %s", verified_tokens.stats())
+
+
+def dump_sessions(verifier: Verifier):
+    """
+    Debug command (kill -USR1): the whole state, which is never logged while verifying
+    """
+    event_log.flush()
+    plog(verifier.session)
+    log(f"Pending requests: {len(verifier.connections)}, partial bodies: {len(verifier.waiting_bodies)}")
+
+
+async def serve(args, pool: WorkerPool | None):
+    loop = asyncio.get_running_loop()
+    if args.empty:
+        listener = Listener(None)
+    elif pool is None:
+        store = PickleStore(args.session_file, args.waiting_file)
+        store.retention.max_messages, store.retention.idle_seconds = args.max_messages, args.idle_seconds
+        verifier = Verifier(store.session, store.waiting_bodies, store.connections, store.retention)
+        if args.audit:
+            auditor = Auditor(verifier)
+            auditor.start()
+            listener = Listener(verifier, auditor=auditor)
+            loop.add_signal_handler(signal.SIGUSR1, auditor.dump)
+        else:
+            listener = Listener(verifier)
+            loop.add_signal_handler(signal.SIGUSR1, dump_sessions, verifier)
+            sweeper = asyncio.create_task(sweep_periodically(verifier))
+    else:
+        listener = Listener(None, pool)
+        pool.attach(loop)
+        loop.add_signal_handler(signal.SIGUSR1, pool.dump)
+    event_log.set_sink(AsyncSink())
+    if not args.empty and pool is None:  # The workers verify the tokens, and refresh their own keys
+        signing_keys.refresh_in_background()
+    server = await asyncio.start_server(listener.serve_client, args.address, args.port)
+    unix_server = None
+    if args.unix is not None:
+        if os.path.exists(args.unix):
+            os.remove(args.unix)  # Left by a listener that didn't stop cleanly
+        unix_server = await asyncio.start_unix_server(listener.serve_frames, args.unix)
+    stop = loop.create_future()
+
+    def request_stop():
+        if not stop.done():  # A second signal may arrive while shutting down
+            stop.set_result(None)
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, request_stop)
+    log(f"Listening on {args.address}:{args.port}" + (f" and {args.unix}" if unix_server is not None else "") + (f" with {pool.workers} workers..." if pool is not None else "..."))
+    async with server:
+        await stop
+    if unix_server is not None:
+        unix_server.close()
+        os.remove(args.unix)
+    if pool is None:
+        event_log.info("JWT cache: %s", verified_tokens.stats())
+    if pool is not None:
+        pool.stop()
+    elif args.audit:
+        auditor.stop()
+        event_log.info("Audit: %s", auditor.metrics())
+        store.commit()
+    elif not args.empty:
+        sweeper.cancel()
+        store.commit()
+    event_log.sink.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Persistent verification server for the TLMSP middlebox handlers")
+    parser.add_argument("-a", "--address", help="Address to listen on", default="localhost")
+    parser.add_argument("-p", "--port", help="Port to listen on", type=int, default=8080)
+    parser.add_argument("-u", "--unix", help="Also listen for binary frames on this Unix socket (NewMiddlebox/client.py uses /tmp/middlebox.sock)", default=None)
+    parser.add_argument("--session-file", help="Load the sessions from this file at startup, and save them on exit (one file per worker)", default=None)
+    parser.add_argument("--waiting-file", help="Load the partial bodies from this file at startup, and save them on exit", default=None)
+    parser.add_argument("--max-messages", help="Messages kept in the history of each user", type=int, default=MAX_MESSAGES_PER_USER)
+    parser.add_argument("--idle-seconds", help="Seconds after which an inactive user's session is forgotten", type=float, default=SESSION_IDLE_SECONDS)
+    parser.add_argument("-w", "--workers", help="Worker processes verifying the messages, each owning the sessions of part of the users", type=int, default=1)
+    parser.add_argument("--audit", help="Forward every message at once and verify it in the background, only recording the violations", action="store_true")
+    parser.add_argument("--empty", help="Forward every message without verifying it, to measure the transport alone", action="store_true")
+    parser.add_argument("--schema-backend", help="Validator used for the JSON schemas", choices=SchemaRegistry.BACKENDS, default="codegen")  # As randomize.py, needed to skip the large strings
+    args = parser.parse_args()
+    if args.audit and args.workers > 1:
+        parser.error("--audit verifies in a single thread, it can't be used with --workers")
+    schema_registry.set_backend(args.schema_backend)
+    if not check_schemas():
+        sys.exit(1)
+    pool = None
+    if args.workers > 1 and not args.empty:
+        pool = WorkerPool(args.workers, args)
+        pool.start()
+    asyncio.run(serve(args, pool))
+
+
+if __name__ == "__main__":
+    main()
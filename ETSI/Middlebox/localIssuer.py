@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import jwt
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwtParser import log
+
+# Stand-in for the OIDC issuer, to test the middlebox without internet access: it serves the openid-configuration and the
+# JWKS of a local RSA key, and mints ID tokens signed with it. Run the handlers with OIDC_ISSUER=http://<address>:<port>,
+# or use --write-jwks to create jwks.dat for OIDC_OFFLINE=1 without running the server
+
+
+class LocalIssuer:
+    def __init__(self, url: str, key_file: str = "issuer_key.pem"):
+        self.url = url
+        if os.path.isfile(key_file):
+            self.key = serialization.load_pem_private_key(open(key_file, "rb").read(), password=None)
+        else:
+            self.key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+            with open(key_file, "wb") as f:
+                f.write(self.key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+        self.kid = uuid.uuid5(uuid.NAMESPACE_URL, json.dumps(self.jwk(), sort_keys=True)).hex
+
+    def jwk(self) -> dict:
+        return json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self.key.public_key()))
+
+    def jwks(self) -> dict:
+        return {"keys": [{**self.jwk(), "kid": self.kid, "alg": "RS256", "use": "sig"}]}
+
+    def openid_configuration(self) -> dict:
+        return {"issuer": self.url, "jwks_uri": self.url + "/jwks", "id_token_signing_alg_values_supported": ["RS256"]}
+
+    def mint(self, email: str, lifetime: int = 3600) -> str:
+        now = int(time.time())
+        return jwt.encode({"iss": self.url, "sub": email, "email": email, "iat": now, "exp": now + lifetime}, self.key, algorithm="RS256", headers={"kid": self.kid})
+
+
+def serve(issuer: LocalIssuer, address: str, port: int, jwks_lifetime: int):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/.well-known/openid-configuration":
+                out = issuer.openid_configuration()
+            elif self.path == "/jwks":
+                out = issuer.jwks()
+            elif self.path.startswith("/token/"):
+                out = {"id_token": issuer.mint(self.path[len("/token/"):])}
+            else:
+                self.send_error(404)
+                return
+            body = json.dumps(out).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Expires", time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + jwks_lifetime)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log(format % args)
+
+    log(f"Issuer {issuer.url} listening on {address}:{port}...")
+    ThreadingHTTPServer((address, port), Handler).serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OIDC issuer for testing the middlebox offline")
+    parser.add_argument("-a", "--address", help="Address to listen on", default="localhost")
+    parser.add_argument("-p", "--port", help="Port to listen on", type=int, default=8090)
+    parser.add_argument("--key-file", help="Signing key, created if missing", default="issuer_key.pem")
+    parser.add_argument("--jwks-lifetime", help="Seconds the JWKS can be cached for (Expires header)", type=int, default=3600)
+    parser.add_argument("--token", help="Print a token for this email and exit", metavar="EMAIL")
+    parser.add_argument("--write-jwks", help="Write the JWKS to this file and exit", metavar="FILE")
+    args = parser.parse_args()
+
+    issuer = LocalIssuer(f"http://{args.address}:{args.port}", args.key_file)
+    if args.token is not None:
+        print(issuer.mint(args.token))
+    elif args.write_jwks is not None:
+        with open(args.write_jwks, "w") as f:
+            json.dump(issuer.jwks(), f)
+    else:
+        serve(issuer, args.address, args.port, args.jwks_lifetime)
+
+
+if __name__ == "__main__":
+    main()
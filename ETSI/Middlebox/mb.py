@@ -2,14 +2,18 @@ import os
 import pickle
 import re
 import sys
-from pprint import pprint
 import requests
 from typing import Type, Callable
 from MessageTypes import *
 from jwtParser import *
+from eventLog import event_log, Payload, ALLOW, PASS, DROP, BLOCK
+from httpParser import HttpMessage, HttpParser, InvalidMessage
+from verifier import ConnectionIndex, SessionRetention, Verifier
 
 
 class Message:
+    __slots__ = ("connection_id", "type", "data", "response_code")
+
     def __init__(self, connection_id: int, type: Type[MessageType], data: object, response_code: int):
         self.connection_id = connection_id
         self.type = type
@@ -46,116 +50,83 @@ states = [
 ]
 
 
-def log(*args, **kwargs):
-    print(*args, file=sys.stderr, **kwargs)
-
-
 def main():
-    session = {}
+    session, connections, retention = {}, ConnectionIndex(), SessionRetention()
     if os.path.isfile("session.dat"):
-        session = pickle.load(open("session.dat", "rb"))
+        session, connections, retention = pickle.load(open("session.dat", "rb"))
+    retention.sweep(session)
     waiting_bodies = {}
     if os.path.isfile("waiting.dat"):
         waiting_bodies = pickle.load(open("waiting.dat", "rb"))
     connection_id = int(sys.argv[1])
     splice_id = int(sys.argv[2])
     is_response = bool(int(sys.argv[3]))
-    print(f"{connection_id} {splice_id} {is_response}")
-    log(f"{connection_id} {splice_id} {is_response}")
-    input_data = sys.stdin.read()
+    event_log.debug("Connection %s, splice %s, %s", connection_id, splice_id, "response" if is_response else "request")
+    input_data = sys.stdin.buffer.read()
     if input_data is None:
         return
-    print("\033[1;2m" + input_data + "\033[0m")
-    if connection_id in waiting_bodies:
-        body = input_data
-        match_groups, headers, old_body = waiting_bodies[connection_id]
-        body = old_body + body
-        if not is_response:
-            method, uri, http_version = match_groups
-        else:
-            http_version, response_code = match_groups
-    else:
-        header, body = input_data.split("\r\n\r\n", 1)
-        tmp = header.split("\r\n")
-        req = tmp.pop(0)
-
-        if not is_response:
-            match = re.match(r"(GET|POST|HEAD|PUT|DELETE) ([^ ]+) HTTP/(\d+(?:\.\d+)?)", req)
-            if not match:
-                print("Invalid request")
-                sys.exit(1)
-            method, uri, http_version = match.groups()
-        else:
-            match = re.match(r"HTTP/(\d+(?:\.\d+)?) (\d+)", req)
-            if not match:
-                print("Invalid response")
-                sys.exit(1)
-            http_version, response_code = match.groups()
-        match_groups = match.groups()
-
-        headers = {line.split(": ")[0]: line.split(": ", 1)[1] for line in tmp}
-
-    if len(body) < int(headers.get("Content-Length", 0)):
-        print("Waiting for body for connection " + str(connection_id))
-        waiting_bodies[connection_id] = match_groups, headers, body
-        print(waiting_bodies)
+    event_log.debug("%s", Payload(input_data))
+    key = f"{connection_id}-{'response' if is_response else 'request'}"
+    parser = waiting_bodies[key] if key in waiting_bodies else HttpParser(is_response)
+    try:
+        messages = parser.feed(input_data)
+    except InvalidMessage as e:
+        event_log.verdict(connection_id, is_response, BLOCK, None, None, str(e))
+        sys.exit(1)
+    if len(parser) > 0:
+        event_log.debug("Waiting for body for connection %s (%s bytes received)", connection_id, len(parser))
+        waiting_bodies[key] = parser
         pickle.dump(waiting_bodies, open("waiting.dat", "wb"))
-        sys.exit(0)
-    elif connection_id in waiting_bodies:
-        del waiting_bodies[connection_id]
+    elif key in waiting_bodies:
+        del waiting_bodies[key]
         pickle.dump(waiting_bodies, open("waiting.dat", "wb"))
 
-    if not is_response:
-        print(f"method: {method}, uri: {uri}, http_version: {http_version}")
-
-        user = "Unknown"
-        if "Authorization" in headers:
-            try:
-                id_token = headers["Authorization"]
-                if id_token.startswith("Bearer "):
-                    id_token = headers["Authorization"][7:]
-                user = parse_jwt(id_token)["email"]
-            except Exception as e:
-                print("\033[1;33mCouldn't get email from token: " + str(e) + "\033[0m")
-        else:
-            print("\033[33mNo auth token in request\033[0m")
+    for message in messages:
+        observe(session, connections, retention, connection_id, is_response, message)
+
+    pickle.dump((session, connections, retention), open("session.dat", "wb"))
 
-        message_type = None
+
+def observe(session: dict, connections: ConnectionIndex, retention: SessionRetention, connection_id: int, is_response: bool, http_message: HttpMessage):
+    headers, body = http_message.headers, http_message.body
+    if not is_response:
+        method, uri, http_version = http_message.start
+        event_log.debug("method: %s, uri: %s, http_version: %s", method, uri, http_version)
+        user = Verifier.authenticate(headers)
         message_data = None
+        validation_error = None
 
-        user_session_tmp = session.get(user, {"messages": [], "created_products": [], "has_seen_products": False})  # To keep the session list clean, initialize a new session now but save it later only if there's a match
-        for test_message_type in MessageType.__subclasses__():
-            if test_message_type.match_request(method, uri, headers, body):
-                message_type = test_message_type
-                user_session_tmp, message_data = test_message_type.parse_request(user_session_tmp, method, uri, headers, body)
-                if (validation_error := test_message_type.validate_request(user_session_tmp, message_data)) is not None:
-                    print("\033[1;33mValidation error: " + validation_error + "\033[0m")
-                break
+        user_session_tmp = session.get(user) or retention.new_session(created_products=[], has_seen_products=False)  # To keep the session list clean, initialize a new session now but save it later only if there's a match
+        request = ParsedRequest(method, uri, headers, body)
+        message_type = message_router.route(request)
+        if message_type is not None:
+            user_session_tmp, message_data, validation_error = message_type.check_request(user_session_tmp, request)
 
         if message_type is None:
-            print("\033[1;31mNo match\033[0m")
+            event_log.verdict(connection_id, False, BLOCK, user, None, "no match")
         else:
+            event_log.verdict(connection_id, False, ALLOW if validation_error is None else BLOCK, user, message_type, validation_error or "")
             session[user] = user_session_tmp
-            session[user]["messages"].append(Message(connection_id, message_type, message_data, 0))
+            message = Message(connection_id, message_type, message_data, 0)
+            retention.append(session[user], message)
+            connections.add(connection_id, user, message)
     else:
+        http_version, response_code = http_message.start
         response_code = int(response_code)
-        indexes = []
-        for user, user_session in session.items():
-            indexes += [(idx, user) for idx, message in enumerate(user_session["messages"]) if message.connection_id == connection_id]
-        if len(indexes) != 1:
-            print(f"\033[1;31mFound {len(indexes)} messages with connection_id {connection_id}\033[0m")
+        pending = connections.pop(connection_id)
+        if pending is None:
+            event_log.verdict(connection_id, True, DROP, None, None, "no pending request")
+        elif pending[0] not in session:
+            event_log.verdict(connection_id, True, PASS, pending[0], None, "session expired")
         else:
-            index, user = indexes[0]
-            message_type = session[user]["messages"][index].type
-            if session[user]["messages"][index].data is not None and session[user]["messages"][index].data.get("invalid", False):
-                print("\033[1;33mResponse is relative to an invalid message, not parsing\033[0m")
-                pass
+            user, message = pending
+            message_type = message.type
+            if message.data is not None and message.data.get("invalid", False):
+                event_log.verdict(connection_id, True, PASS, user, message_type, "response to an invalid request")
             else:
-                session[user], session[user]["messages"][index].data = message_type.parse_response(session[user], session[user]["messages"][index].data, response_code, body)
-            session[user]["messages"][index].response_code = response_code
-
-    pprint(session)
-    pickle.dump(session, open("session.dat", "wb"))
+                session[user], message.data = message_type.parse_response(session[user], message.data, response_code, str(body, "utf-8", "replace"))
+                event_log.verdict(connection_id, True, ALLOW, user, message_type, f"response code {response_code}")
+            message.response_code = response_code
 
 
 if __name__ == "__main__":
@@ -0,0 +1,232 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+import zlib
+from typing import Callable
+from MessageTypes import *
+from eventLog import event_log
+from httpParser import HttpParser
+from verifier import Verifier, fsm
+
+# Offline replay of recorded traffic through the verifier, without TLMSP, the VMs or OpenFaaS: the capture is sharded by user
+# over a pool of processes, each with its own in-memory Verifier (as listener.py), and pushed through it as fast as possible.
+# Reports the messages per second, the verdicts and the time spent in each stage of the verification.
+# A capture is a JSONL file with one message per line, in the order they were seen:
+#     {"connection_id": 1, "is_response": false, "data": "POST /function/init HTTP/1.1\r\n...", "user": "a@b.c"}
+# where data is the raw message and user (optional) is the key to shard by; without it, the Authorization or X-User header is used.
+# The responses are sent to the process of the request of the same connection. A capture can be generated by looping over a
+# request list as PerformanceMeasuring/measure.py does (--generate), and every request carries the X-Code issued by the replayed
+# responses, unless --keep-codes
+
+STAGES = ["http parsing", "authentication", "routing", "schema validation"]  # Of the requests
+RESPONSE_STAGES = ["response http parsing"]
+CODE_HEADER = re.compile(rb"X-Code-([0-9a-f]+): ([0-9a-f]+)")
+
+
+class ReplayVerifier(Verifier):
+    def authenticate(self, headers: dict[str, str]) -> str:
+        if "X-User" in headers:
+            return headers["X-User"]
+        return super().authenticate(headers)
+
+
+def generate(requests: list[dict], users: int, loops: int) -> list[dict]:
+    """
+    Every user sends the requests in order, loops times, each answered by a 200 response; "{}" in a body is replaced with the loop
+    number. The users are interleaved, one request each at a time
+    """
+    capture = []
+    connection_id = 0
+    for loop in range(loops):
+        for request in requests:
+            url = "/function/" + request["path"]
+            body = request["post_data"].replace("{}", str(loop)).encode("utf-8")
+            for u in range(users):
+                user = f"user{u}@example.com"
+                connection_id += 1
+                data = f"POST {url} HTTP/1.1\r\nHost: localhost\r\nX-User: {user}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode("utf-8") + body
+                capture.append({"connection_id": connection_id, "is_response": False, "data": data, "user": user})
+                capture.append({"connection_id": connection_id, "is_response": True, "data": b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n"})
+    return capture
+
+
+def load(filename: str) -> list[dict]:
+    capture = []
+    with open(filename) as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            message = json.loads(line)
+            message["data"] = message["data"].encode("utf-8", "surrogateescape")
+            capture.append(message)
+    return capture
+
+
+def save(capture: list[dict], filename: str):
+    with open(filename, "w") as f:
+        for message in capture:
+            f.write(json.dumps({**message, "data": str(message["data"], "utf-8", "surrogateescape")}) + "\n")
+
+
+def shard_key(message: dict) -> str:
+    if "user" in message:
+        return message["user"]
+    for name in (b"\r\nX-User:", b"\r\nAuthorization:"):
+        start = message["data"].find(name)
+        if start != -1:
+            end = message["data"].find(b"\r\n", start + len(name))
+            return message["data"][start + len(name):end].strip().decode("utf-8", "replace")
+    return str(message["connection_id"])
+
+
+def shard(capture: list[dict], processes: int, keep_codes: bool) -> list[list[tuple]]:
+    """
+    (connection_id, is_response, data, user, code_header) for each process, code_header being the X-Code-* header of the request,
+    whose X-Code is filled in at replay time (None to send the data as it is)
+    """
+    shards = [[] for _ in range(processes)]
+    owners = {}
+    for message in capture:
+        connection_id, is_response, data = message["connection_id"], bool(message["is_response"]), message["data"]
+        if is_response:
+            if connection_id in owners:
+                shards[owners[connection_id]].append((connection_id, True, data, None, None))
+            continue
+        user = shard_key(message)
+        owners[connection_id] = zlib.crc32(user.encode("utf-8")) % processes
+        code_header = None
+        if not keep_codes and (match := re.match(rb"[A-Z]+ ([^ ]+) ", data)):
+            data = re.sub(rb"\r\nX-Code:[^\r]*", b"", data, count=1)
+            code_header = hashlib.md5(match.group(1)).hexdigest().encode()
+        shards[owners[connection_id]].append((connection_id, False, data, user, code_header))
+    return shards
+
+
+def instrument(owner: type, name: str, stage: str | Callable[..., str], stages: dict[str, int]):
+    """
+    Adds the time spent in owner.name to stages[stage], or to the stage returned by stage called with the arguments
+    """
+    wrapped = getattr(owner, name)
+    is_class_level = isinstance(owner.__dict__[name], (classmethod, staticmethod))
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return wrapped(*args, **kwargs)
+        finally:
+            stages[stage(*args) if callable(stage) else stage] += time.perf_counter_ns() - start
+
+    setattr(owner, name, staticmethod(timed) if is_class_level else timed)
+
+
+def prepare(schema_backend: str, quiet: bool):
+    schema_registry.set_backend(schema_backend)
+    if not check_schemas():
+        sys.exit(1)
+    fsm.code_headers
+    if quiet:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), 2)
+
+
+def replay(messages: list[tuple]) -> tuple[float, dict[str, int], dict[str, int], int]:
+    """
+    Returns the elapsed seconds, the verdicts, the nanoseconds spent in each stage, and the messages processed
+    """
+    stages = {stage: 0 for stage in STAGES + RESPONSE_STAGES + ["requests", "responses"]}
+    verdicts = {}
+
+    def count(connection_id, is_response, verdict, user, message_type, reason=""):
+        key = f"{'response' if is_response else 'request'} {verdict}" + (f" ({re.sub(r'[0-9]+', 'N', reason)})" if reason else "")
+        verdicts[key] = verdicts.get(key, 0) + 1
+
+    event_log.verdict = count
+    instrument(HttpParser, "feed", lambda parser, data: "response http parsing" if parser.is_response else "http parsing", stages)
+    instrument(ReplayVerifier, "authenticate", "authentication", stages)
+    instrument(type(fsm.router), "route", "routing", stages)
+    instrument(MessageType, "validate_schemas", "schema validation", stages)
+
+    verifier = ReplayVerifier()
+    verifier.retention.sweep_interval = float("inf")
+    codes = {}
+    users = {}
+    start = time.perf_counter()
+    for connection_id, is_response, data, user, code_header in messages:
+        if code_header is not None:
+            end = data.index(b"\r\n")
+            data = data[:end] + b"\r\nX-Code: " + codes.get(user, {}).get(code_header, b"") + data[end:]
+        message_start = time.perf_counter_ns()
+        output = verifier.process(connection_id, is_response, data)
+        stages["responses" if is_response else "requests"] += time.perf_counter_ns() - message_start
+        if not is_response:
+            users[connection_id] = user
+        elif connection_id in users:
+            user = users.pop(connection_id)
+            if output:
+                codes[user] = dict(CODE_HEADER.findall(output))
+    return time.perf_counter() - start, verdicts, stages, len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a capture through the verifier, without TLMSP")
+    parser.add_argument("capture", help="JSONL capture to replay", nargs="?")
+    parser.add_argument("-p", "--processes", help="Processes to shard the users over", type=int, default=os.cpu_count())
+    parser.add_argument("-g", "--generate", help="Generate the capture from this request list (as PerformanceMeasuring/requests.json)", metavar="REQUESTS")
+    parser.add_argument("-u", "--users", help="Users of the generated capture", type=int, default=100)
+    parser.add_argument("-l", "--loops", help="Loops over the request list of the generated capture", type=int, default=10)
+    parser.add_argument("-o", "--output", help="Save the generated capture to this file instead of replaying it")
+    parser.add_argument("--keep-codes", help="Send the X-Code headers of the capture instead of the ones issued while replaying", action="store_true")
+    parser.add_argument("--schema-backend", help="Validator used for the JSON schemas", choices=SchemaRegistry.BACKENDS, default=schema_registry.backend)
+    parser.add_argument("-v", "--verbose", help="Show the logs of the verifier", action="store_true")
+    args = parser.parse_args()
+
+    if args.generate is not None:
+        with open(args.generate) as f:
+            capture = generate(json.load(f), args.users, args.loops)
+        if args.output is not None:
+            save(capture, args.output)
+            return
+    elif args.capture is not None:
+        capture = load(args.capture)
+    else:
+        parser.error("a capture or --generate is required")
+
+    shards = shard(capture, args.processes, args.keep_codes)
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.processes, initializer=prepare, initargs=(args.schema_backend, not args.verbose)) as pool:
+        results = pool.map(replay, shards, chunksize=1)
+    wall = time.perf_counter() - start
+
+    messages = sum(result[3] for result in results)
+    slowest = max(result[0] for result in results)
+    verdicts, stages = {}, {}
+    for _, shard_verdicts, shard_stages, _ in results:
+        for key, value in shard_verdicts.items():
+            verdicts[key] = verdicts.get(key, 0) + value
+        for key, value in shard_stages.items():
+            stages[key] = stages.get(key, 0) + value
+    requests = sum(value for key, value in verdicts.items() if key.startswith("request"))
+    responses = messages - requests
+
+    print(f"{messages} messages ({len(capture) - messages} responses without a request skipped) on {args.processes} processes")
+    print(f"Throughput: {messages / slowest:.0f} messages/s (slowest process {slowest:.2f}s), {messages / wall:.0f} messages/s including startup ({wall:.2f}s)")
+    print("Verdicts:")
+    for key, value in sorted(verdicts.items(), key=lambda item: -item[1]):
+        print(f"    {key:60} {value:8} {100 * value / messages:6.2f}%")
+    print("Time per message (us):")
+    print(f"    {'request':40} {stages['requests'] / max(requests, 1) / 1000:10.2f}")
+    for stage in STAGES:
+        print(f"        {stage:36} {stages[stage] / max(requests, 1) / 1000:10.2f}")
+    print(f"        {'other (FSM, codes, session)':36} {(stages['requests'] - sum(stages[stage] for stage in STAGES)) / max(requests, 1) / 1000:10.2f}")
+    print(f"    {'response':40} {stages['responses'] / max(responses, 1) / 1000:10.2f}")
+    for stage in RESPONSE_STAGES:
+        print(f"        {stage.removeprefix('response '):36} {stages[stage] / max(responses, 1) / 1000:10.2f}")
+    print(f"        {'other (FSM, codes, session)':36} {(stages['responses'] - sum(stages[stage] for stage in RESPONSE_STAGES)) / max(responses, 1) / 1000:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
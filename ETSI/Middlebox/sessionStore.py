@@ -0,0 +1,308 @@
+import fcntl
+import os
+import pickle
+import sqlite3
+import zlib
+from collections.abc import MutableMapping
+from verifier import ConnectionIndex, SessionRetention
+
+# Storage of the verifier state (sessions, pending requests and partial bodies) between handler invocations.
+# A store exposes session, waiting_bodies, connections and retention to be passed to Verifier, and commit() to persist them
+
+
+class PickleStore:
+    """
+    The whole state is loaded at startup and pickled again at every commit, as randomize.py has always done
+    """
+
+    def __init__(self, session_file: str = "session.dat", waiting_file: str = "waiting.dat"):
+        self.session_file = session_file
+        self.waiting_file = waiting_file
+        self.session, self.connections, self.retention = {}, ConnectionIndex(), SessionRetention()
+        if session_file is not None and os.path.isfile(session_file):
+            self.session, self.connections, self.retention = pickle.load(open(session_file, "rb"))
+        self.waiting_bodies = {}
+        if waiting_file is not None and os.path.isfile(waiting_file):
+            self.waiting_bodies = pickle.load(open(waiting_file, "rb"))
+
+    def commit(self, session: bool = True, waiting: bool = True):
+        """
+        session or waiting False skips rewriting a file the message didn't change; only PickleStore takes these flags,
+        since SqliteStore.commit() already writes just the rows that were used
+        """
+        if session and self.session_file is not None:
+            pickle.dump((self.session, self.connections, self.retention), open(self.session_file, "wb"))
+        if waiting and self.waiting_file is not None:
+            pickle.dump(self.waiting_bodies, open(self.waiting_file, "wb"))
+
+    def close(self):
+        pass
+
+
+class KeyLocks:
+    """
+    Exclusive locks shared by all the handler processes, one for each bucket of keys of a namespace, held until release_all().
+    Handlers working on different users can run in parallel, while the read-modify-write of the same user is serialized.
+    A handler locks at most one key per namespace, always in the same namespace order, so no deadlock is possible
+    """
+
+    def __init__(self, directory: str, buckets: int = 256):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.buckets = buckets
+        self.held = {}
+
+    def acquire(self, namespace: str, key: str, blocking: bool = True) -> bool:
+        bucket = (namespace, zlib.crc32(key.encode("utf-8")) % self.buckets)
+        if bucket in self.held:
+            return True
+        fd = os.open(os.path.join(self.directory, f"{bucket[0]}-{bucket[1]}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.held[bucket] = fd
+        return True
+
+    def release_all(self):
+        for fd in self.held.values():
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        self.held.clear()
+
+
+class SqliteMapping(MutableMapping):
+    """
+    Dictionary backed by a sqlite table, one pickled row per key.
+    Values are loaded when first used and cached; every value read through [] or get() may be modified in place by the caller,
+    so it is written back at the next commit together with the assigned and deleted keys. Iterating doesn't mark values as changed.
+    With locks, a key is locked before its value is read, and items(), values() and idle_keys() skip the keys locked by other processes
+    """
+
+    def __init__(self, db: sqlite3.Connection, table: str, locks: KeyLocks | None = None):
+        self.db = db
+        self.table = table
+        self.locks = locks
+        self.cache = {}
+        self.dirty = set()
+        self.deleted = set()
+        db.execute(f"CREATE TABLE IF NOT EXISTS {table} (key PRIMARY KEY, last_seen REAL, data BLOB)")
+
+    def lock(self, key, blocking: bool = True) -> bool:
+        return self.locks is None or self.locks.acquire(self.table, str(key), blocking)
+
+    def _load(self, key):
+        if key in self.cache:
+            return self.cache[key]
+        if key in self.deleted:
+            raise KeyError(key)
+        self.lock(key)
+        row = self.db.execute(f"SELECT data FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        self.cache[key] = pickle.loads(row[0])
+        return self.cache[key]
+
+    def __getitem__(self, key):
+        value = self._load(key)
+        self.dirty.add(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.lock(key)
+        self.cache[key] = value
+        self.dirty.add(key)
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        self._load(key)
+        del self.cache[key]
+        self.dirty.discard(key)
+        self.deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self.cache:
+            return True
+        if key in self.deleted:
+            return False
+        return self.db.execute(f"SELECT 1 FROM {self.table} WHERE key = ?", (key,)).fetchone() is not None
+
+    def __iter__(self):
+        keys = set(self.cache)
+        for (key,) in self.db.execute(f"SELECT key FROM {self.table}").fetchall():
+            if key not in self.deleted:
+                keys.add(key)
+        return iter(keys)
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def items(self):
+        return [(key, self._load(key)) for key in self if key in self.cache or self.lock(key, blocking=False)]
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def idle_keys(self, cutoff: float) -> list:
+        """
+        Keys whose value has a last_seen older than cutoff, without loading the other values
+        """
+        keys = {key for key, value in self.cache.items() if value["last_seen"] < cutoff}
+        for (key,) in self.db.execute(f"SELECT key FROM {self.table} WHERE last_seen < ?", (cutoff,)).fetchall():
+            if key not in self.deleted and key not in self.cache and self.lock(key, blocking=False):
+                keys.add(key)
+        return list(keys)
+
+    def flush(self):
+        for key in self.dirty:
+            value = self.cache[key]
+            last_seen = value.get("last_seen") if isinstance(value, dict) else None
+            self.db.execute(f"INSERT OR REPLACE INTO {self.table} (key, last_seen, data) VALUES (?, ?, ?)", (key, last_seen, pickle.dumps(value)))
+        for key in self.deleted:
+            self.db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+        self.cache.clear()
+        self.dirty.clear()
+        self.deleted.clear()
+
+
+class SqliteConnectionIndex:
+    """
+    ConnectionIndex kept in a sqlite table: only the user is stored, and the message is found again in that user's (bounded) history
+    """
+
+    def __init__(self, db: sqlite3.Connection, session: SqliteMapping):
+        self.db = db
+        self.session = session
+        db.execute("CREATE TABLE IF NOT EXISTS pending (seq INTEGER PRIMARY KEY AUTOINCREMENT, connection_id INTEGER, user TEXT)")
+        db.execute("CREATE INDEX IF NOT EXISTS pending_connection ON pending (connection_id, seq)")
+
+    def add(self, connection_id: int, user: str, message: object):
+        self.db.execute("INSERT INTO pending (connection_id, user) VALUES (?, ?)", (connection_id, user))
+
+    def pop(self, connection_id: int) -> tuple[str, object] | None:
+        while True:
+            row = self.db.execute("SELECT seq, user FROM pending WHERE connection_id = ? ORDER BY seq LIMIT 1", (connection_id,)).fetchone()
+            if row is None:
+                return None
+            seq, user = row
+            user_session = self.session.get(user)  # Locks the user before starting to write, as every other handler does
+            if self.db.execute("DELETE FROM pending WHERE seq = ?", (seq,)).rowcount == 1:
+                break
+        return user, self.find(connection_id, user_session["messages"] if user_session is not None else [])
+
+    def discard(self, connection_id: int) -> tuple[str, object] | None:
+        row = self.db.execute("SELECT seq, user FROM pending WHERE connection_id = ? ORDER BY seq DESC LIMIT 1", (connection_id,)).fetchone()
+        if row is None:
+            return None
+        seq, user = row
+        user_session = self.session.get(user)
+        self.db.execute("DELETE FROM pending WHERE seq = ?", (seq,))
+        return user, self.find(connection_id, reversed(user_session["messages"]) if user_session is not None else [])
+
+    def pending_messages(self, connection_id: int, user: str) -> list:
+        count = self.db.execute("SELECT COUNT(*) FROM pending WHERE connection_id = ? AND user = ?", (connection_id, user)).fetchone()[0]
+        if count == 0:
+            return []
+        user_session = self.session.get(user)
+        messages = [message for message in user_session["messages"] if message.connection_id == connection_id and message.valid and message.response_code == 0] if user_session is not None else []
+        return messages[len(messages) - count:] if count < len(messages) else messages
+
+    def prune(self, session: SqliteMapping, max_messages: int | None) -> int:
+        """
+        As ConnectionIndex.prune: the rows of the users no longer in session, and all but the newest max_messages of each user,
+        since find only looks in the history of the user
+        """
+        evicted = [user for (user,) in self.db.execute("SELECT DISTINCT user FROM pending").fetchall() if user not in session]
+        pruned = sum(self.db.execute("DELETE FROM pending WHERE user = ?", (user,)).rowcount for user in evicted)
+        if max_messages is not None:
+            pruned += self.db.execute("DELETE FROM pending WHERE seq IN (SELECT seq FROM (SELECT seq, ROW_NUMBER() OVER (PARTITION BY user ORDER BY seq DESC) AS n FROM pending) WHERE n > ?)", (max_messages,)).rowcount
+        return pruned
+
+    @staticmethod
+    def find(connection_id: int, messages) -> object | None:
+        """
+        The first of messages forwarded on the connection and still waiting for a response, oldest first for pop and newest first
+        for discard, since a connection kept alive may have several
+        """
+        for message in messages:
+            if message.connection_id == connection_id and message.valid and message.response_code == 0:
+                return message
+        return None
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+
+
+class SqliteCodeExpiry:
+    """
+    CodeExpiry in a sqlite table indexed by expiration, shared by all the handler processes: one row per user with codes,
+    and the due users are found and removed through the index
+    """
+
+    def __init__(self, db: sqlite3.Connection):
+        self.db = db
+        db.execute("CREATE TABLE IF NOT EXISTS code_expiry (user TEXT PRIMARY KEY, expiration REAL)")
+        db.execute("CREATE INDEX IF NOT EXISTS code_expiry_expiration ON code_expiry (expiration)")
+
+    def schedule(self, user: str, expiration: float):
+        self.db.execute("INSERT INTO code_expiry (user, expiration) VALUES (?, ?) ON CONFLICT (user) DO UPDATE SET expiration = max(expiration, excluded.expiration)", (user, expiration))
+
+    def due(self, now: float) -> list[tuple[str, float]]:
+        return self.db.execute("DELETE FROM code_expiry WHERE expiration < ? RETURNING user, expiration", (now,)).fetchall()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM code_expiry").fetchone()[0]
+
+
+class SqliteStore:
+    """
+    One row per user, per pending request and per partial body: a commit only writes the rows that were used, in a single transaction,
+    so the cost doesn't grow with the number of users. Uncommitted changes of an interrupted handler are rolled back by sqlite.
+    Several handler processes can share the store: users and partial bodies are locked from their first read until the commit,
+    and the sessions swept by Verifier.sweep() must be committed before processing a message
+    """
+    COUNTERS = ["evicted_messages", "evicted_users", "expired_codes", "evicted_requests"]
+
+    def __init__(self, filename: str = "session.db"):
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.locks = KeyLocks(filename + ".locks")
+        self.session = SqliteMapping(self.db, "users", self.locks)
+        self.waiting_bodies = SqliteMapping(self.db, "waiting", self.locks)
+        self.connections = SqliteConnectionIndex(self.db, self.session)
+        self.db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value REAL)")
+        self.db.executemany("INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)", [(name,) for name in self.COUNTERS + ["last_sweep"]])
+        self.db.commit()
+        self.retention = SessionRetention(code_expiry=SqliteCodeExpiry(self.db))
+        self.load_counters()
+
+    def load_counters(self):
+        """
+        The retention counters are shared by all processes, and only incremented at commit
+        """
+        for name, value in self.db.execute("SELECT name, value FROM counters").fetchall():
+            setattr(self.retention, name, value if name == "last_sweep" else int(value))
+        self.counters = {name: getattr(self.retention, name) for name in self.COUNTERS}
+
+    def commit(self):
+        self.session.flush()
+        self.waiting_bodies.flush()
+        self.db.executemany("UPDATE counters SET value = value + ? WHERE name = ?", [(getattr(self.retention, name) - self.counters[name], name) for name in self.COUNTERS])
+        self.db.execute("UPDATE counters SET value = max(value, ?) WHERE name = 'last_sweep'", (self.retention.last_sweep,))
+        self.db.commit()
+        self.locks.release_all()
+        self.load_counters()
+
+    def close(self):
+        self.db.close()
+        self.locks.release_all()
+
+
+def open_store(kind: str) -> PickleStore | SqliteStore:
+    if kind == "pickle":
+        return PickleStore()
+    elif kind == "sqlite":
+        return SqliteStore()
+    raise ValueError(f"Unknown session store {kind}")
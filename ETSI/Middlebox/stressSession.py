@@ -0,0 +1,103 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+import tempfile
+import time
+from MessageTypes import log
+from sessionStore import PickleStore, SqliteStore
+from verifier import Verifier, states
+
+# Stress test of a session store shared by concurrent handler processes: every request and response is a separate
+# invocation (open the store, process, commit, close) as with randomize.py, the users are spread over the processes and
+# every invocation also sweeps the sessions. At the end every user must have gone through all its FSM transitions
+
+
+class StressVerifier(Verifier):
+    def authenticate(self, headers: dict[str, str]) -> str:
+        return headers["X-User"]
+
+
+def open_store(kind: str, directory: str) -> PickleStore | SqliteStore:
+    if kind == "pickle":
+        return PickleStore(os.path.join(directory, "session.dat"), os.path.join(directory, "waiting.dat"))
+    return SqliteStore(os.path.join(directory, "session.db"))
+
+
+def invoke(kind: str, directory: str, connection_id: int, is_response: bool, data: str) -> str | None:
+    try:
+        return invoke_handler(kind, directory, connection_id, is_response, data)
+    except Exception as e:  # A crashed handler blocks the message, as with tlmsp-mb
+        log(e)
+        return None
+
+
+def invoke_handler(kind: str, directory: str, connection_id: int, is_response: bool, data: str) -> str | None:
+    store = open_store(kind, directory)
+    verifier = StressVerifier(store.session, store.waiting_bodies, store.connections, store.retention)
+    verifier.retention.sweep_interval = 0
+    if verifier.sweep():
+        store.commit()
+    output = verifier.process(connection_id, is_response, data)
+    store.commit()
+    store.close()
+    return output
+
+
+def drive(kind: str, directory: str, worker: int, processes: int, users: list[str], rounds: int, requests: list[dict]) -> int:
+    sys.stderr = open(os.devnull, "w")
+    os.dup2(sys.stderr.fileno(), 2)
+    errors = 0
+    codes = {user: {} for user in users}
+    for round in range(rounds):
+        for n, user in enumerate(users):
+            connection_id = (worker + n * processes) * rounds + round  # users[worker::processes] is this worker's share
+            request = requests[round % len(requests)]
+            url = "/function/" + request["path"]
+            body = request["post_data"].replace("{}", str(n))
+            code = codes[user].get(hashlib.md5(url.encode("utf-8")).hexdigest(), "")
+            data = f"POST {url} HTTP/1.1\r\nX-User: {user}\r\nX-Code: {code}\r\nContent-Length: {len(body)}\r\n\r\n{body}"
+            if invoke(kind, directory, connection_id, False, data) is None:
+                errors += 1
+                continue
+            response = invoke(kind, directory, connection_id, True, "HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+            codes[user] = dict(re.findall(r"X-Code-([0-9a-f]+): ([0-9a-f]+)", (response or b"").decode()))
+            if len(codes[user]) == 0:
+                errors += 1
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--processes", help="Concurrent handler processes", type=int, default=8)
+    parser.add_argument("-u", "--users", help="Users, spread over the processes", type=int, default=32)
+    parser.add_argument("-r", "--rounds", help="FSM transitions of each user", type=int, default=2 * len(states))
+    parser.add_argument("-s", "--store", help="Session store to test", choices=["sqlite", "pickle"], default="sqlite")
+    parser.add_argument("--requests", help="Requests to send, in the order of the FSM", default="../../PerformanceMeasuring/requests.json")
+    args = parser.parse_args()
+
+    with open(args.requests) as f:
+        requests = json.load(f)
+    users = [f"user{u}@example.com" for u in range(args.users)]
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        with multiprocessing.Pool(args.processes) as pool:
+            errors = sum(pool.starmap(drive, [(args.store, directory, w, args.processes, users[w::args.processes], args.rounds, requests) for w in range(args.processes)]))
+        elapsed = time.perf_counter() - start
+
+        store = open_store(args.store, directory)
+        lost = [user for user in users if user not in store.session or store.session[user]["state"] != args.rounds % len(states)]
+        pending = len(store.connections)
+        store.close()
+
+    print(f"{2 * args.users * args.rounds} invocations in {elapsed:.2f}s ({2 * args.users * args.rounds / elapsed:.0f}/s) on {args.processes} processes")
+    print(f"Rejected messages: {errors}, users with lost transitions: {len(lost)}, requests still pending: {pending}")
+    if errors > 0 or len(lost) > 0 or pending > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
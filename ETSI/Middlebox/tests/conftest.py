@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules of the middlebox are scripts in the parent folder, imported as they import each other
+MIDDLEBOX_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MIDDLEBOX_DIR)
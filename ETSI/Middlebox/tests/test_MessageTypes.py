@@ -0,0 +1,24 @@
+from MessageTypes import SchemaCompiler, SchemaRegistry, ProductImageMessageType
+
+
+def test_set_backend_keeps_compiled_validators(monkeypatch):
+    monkeypatch.chdir(__import__("conftest").MIDDLEBOX_DIR)  # The schemas are relative to it
+    registry = SchemaRegistry("codegen")
+    validators = registry.get(ProductImageMessageType)
+    registry.set_backend("codegen")
+    assert registry.get(ProductImageMessageType) is validators
+    registry.set_backend("jsonschema")
+    assert registry.get(ProductImageMessageType) is not validators
+
+
+def test_list_of_types_is_left_to_jsonschema():
+    schema = {"type": "object", "properties": {"name": {"type": ["string", "null"]}}}
+    assert not SchemaCompiler.supports(schema)
+    assert SchemaCompiler.supports({"type": "object", "properties": {"name": {"type": "string"}}})
+
+
+def test_schema_values_with_quotes():
+    validate = SchemaCompiler.compile({"type": "object", "required": ['a"b'], "properties": {"c": {"type": "string", "pattern": "^\"x'$"}}})
+    assert validate({"a\"b": 1, "c": "\"x'"}) is None
+    assert validate({}) == "'a\"b' is a required property"
+    assert validate({"a\"b": 1, "c": "y"}) == "'y' does not match '^\"x\\'$'"
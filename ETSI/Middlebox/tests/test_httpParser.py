@@ -0,0 +1,13 @@
+from httpParser import HttpParser
+
+
+def test_pipelined_requests_without_body():
+    data = b"GET /function/init HTTP/1.1\r\nHost: a\r\n\r\nGET /function/init HTTP/1.1\r\nHost: b\r\n\r\n"
+    messages = HttpParser(False).feed(data)
+    assert [message.headers["Host"] for message in messages] == ["a", "b"]
+    assert all(len(message.body) == 0 for message in messages)
+
+
+def test_response_without_framing_takes_the_rest():
+    messages = HttpParser(True).feed(b"HTTP/1.1 200 OK\r\nConnection: close\r\n\r\nbody")
+    assert len(messages) == 1 and bytes(messages[0].body) == b"body"
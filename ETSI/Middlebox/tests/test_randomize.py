@@ -0,0 +1,32 @@
+import os
+import subprocess
+import sys
+from conftest import MIDDLEBOX_DIR
+
+# randomize.py run as the TLMSP middlebox does, one process per fragment, with the session store in a temporary folder
+
+
+def handler(directory, connection_id: int, data: bytes) -> subprocess.CompletedProcess:
+    if not os.path.exists(os.path.join(directory, "schemas")):
+        os.symlink(os.path.join(MIDDLEBOX_DIR, "schemas"), os.path.join(directory, "schemas"))
+    return subprocess.run([sys.executable, os.path.join(MIDDLEBOX_DIR, "randomize.py"), str(connection_id), "0", "0"], input=data,
+                          capture_output=True, cwd=directory, env={**os.environ, "OIDC_OFFLINE": "1"})
+
+
+def test_blocked_request_is_not_waited_for(tmp_path):
+    header = b"POST /function/product-catalog-builder/image HTTP/1.1\r\nHost: x\r\nContent-Length: 9\r\n\r\n"
+    assert handler(tmp_path, 2, header + b'{"a"').returncode == 0
+    assert handler(tmp_path, 2, b':123}').returncode == 1  # Not allowed in the first state
+    init = b"POST /function/init HTTP/1.1\r\nHost: x\r\nContent-Length: 0\r\n\r\n"
+    result = handler(tmp_path, 2, init)
+    assert result.returncode == 0 and result.stdout == init
+
+
+def test_body_of_blocked_released_request_is_blocked(tmp_path):
+    header = b"POST /function/product-catalog-api/categories HTTP/1.1\r\nHost: x\r\nContent-Length: 11\r\n\r\n"
+    assert handler(tmp_path, 2, header + b'{"a"').returncode == 1  # Released from its header, not allowed in the first state
+    result = handler(tmp_path, 2, b':12345}')
+    assert result.returncode == 1 and b"body of a blocked request" in result.stderr
+    init = b"POST /function/init HTTP/1.1\r\nHost: x\r\nContent-Length: 0\r\n\r\n"
+    result = handler(tmp_path, 2, init)
+    assert result.returncode == 0 and result.stdout == init
@@ -0,0 +1,38 @@
+import os
+import pytest
+from sessionStore import PickleStore, SqliteStore
+from verifier import Verifier
+
+INIT = b"POST /function/init HTTP/1.1\r\nHost: x\r\nX-Testing: 1\r\nContent-Length: 0\r\n\r\n"
+OK = b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n"
+
+
+def open_verifier(tmp_path, kind: str) -> tuple:
+    if kind == "pickle":
+        store = PickleStore(os.path.join(tmp_path, "session.dat"), os.path.join(tmp_path, "waiting.dat"))
+    else:
+        store = SqliteStore(os.path.join(tmp_path, "session.db"))
+    return store, Verifier(store.session, store.waiting_bodies, store.connections, store.retention)
+
+
+@pytest.mark.parametrize("kind", ["pickle", "sqlite"])
+def test_pipelined_request_checked_after_pending_ones(tmp_path, kind):
+    store, verifier = open_verifier(tmp_path, kind)
+    assert verifier.process(1, False, INIT) == INIT
+    assert verifier.process(1, False, INIT) is None  # init again once the first one is answered
+    assert verifier.process(1, True, OK).startswith(b"HTTP/1.1 200 OK\r\n")
+    assert verifier.session["Unknown"]["state"] == 1
+
+
+@pytest.mark.parametrize("kind", ["pickle", "sqlite"])
+def test_sweep_drops_pending_requests(tmp_path, kind):
+    store, verifier = open_verifier(tmp_path, kind)
+    for connection_id in range(300):  # Never answered
+        assert verifier.process(connection_id, False, INIT) == INIT
+    store.commit()
+    verifier.retention.sweep(verifier.session, force=True, connections=verifier.connections)
+    assert len(verifier.connections) == verifier.retention.max_messages  # Only the requests still in the history
+    verifier.retention.idle_seconds = -1
+    verifier.retention.sweep(verifier.session, force=True, connections=verifier.connections)
+    store.commit()
+    assert len(verifier.session) == 0 and len(verifier.connections) == 0
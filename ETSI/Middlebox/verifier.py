@@ -0,0 +1,557 @@
+import heapq
+import os
+import time
+from collections import deque
+from typing import Type
+from MessageTypes import *
+from eventLog import event_log, Payload, ALLOW, PASS, DROP, BLOCK
+from httpParser import HttpParser, InvalidMessage
+from jwtParser import parse_jwt, unverified_claims
+
+CODE_EXPIRATION_SECONDS = 600
+MAX_MESSAGES_PER_USER = 100
+SESSION_IDLE_SECONDS = 3600
+SWEEP_INTERVAL_SECONDS = 60
+
+
+class Message:
+    __slots__ = ("connection_id", "type", "valid", "response_code")
+
+    def __init__(self, connection_id: int, type: Type[MessageType], valid: bool, response_code: int):
+        self.connection_id = connection_id
+        self.type = type
+        self.valid = valid
+        self.response_code = response_code
+
+    def __repr__(self):
+        return f'(connection_id={self.connection_id}, type={self.type}, valid={self.valid}, response_code={self.response_code})'
+
+
+class ConnectionIndex:
+    """
+    Requests still waiting for their response, by connection_id and in the order they were sent on the connection,
+    so that a response is matched without looking through the history of every user
+    """
+
+    def __init__(self):
+        self.pending: dict[int, deque[tuple[str, object]]] = {}
+
+    def add(self, connection_id: int, user: str, message: object):
+        self.pending.setdefault(connection_id, deque()).append((user, message))
+
+    def pop(self, connection_id: int) -> tuple[str, object] | None:
+        """
+        Returns and evicts the oldest pending (user, message) of the connection
+        """
+        queue = self.pending.get(connection_id)
+        if not queue:
+            return None
+        entry = queue.popleft()
+        if len(queue) == 0:
+            del self.pending[connection_id]
+        return entry
+
+    def discard(self, connection_id: int) -> tuple[str, object] | None:
+        """
+        Returns and evicts the newest pending (user, message) of the connection, a request that in the end wasn't forwarded
+        """
+        queue = self.pending.get(connection_id)
+        if not queue:
+            return None
+        entry = queue.pop()
+        if len(queue) == 0:
+            del self.pending[connection_id]
+        return entry
+
+    def pending_messages(self, connection_id: int, user: str) -> list:
+        """
+        The messages of user still waiting for a response on the connection, oldest first
+        """
+        return [message for pending_user, message in self.pending.get(connection_id, ()) if pending_user == user]
+
+    def prune(self, session: dict, max_messages: int | None) -> int:
+        """
+        Forgets the requests that can no longer get a response: those of the users evicted from session, and those evicted from
+        the history of their user (so at most max_messages per user are kept). Returns how many were forgotten
+        """
+        pruned = 0
+        for connection_id, queue in list(self.pending.items()):
+            kept = deque(entry for entry in queue if entry[0] in session and any(message is entry[1] for message in session[entry[0]]["messages"]))
+            pruned += len(queue) - len(kept)
+            if len(kept) == 0:
+                del self.pending[connection_id]
+            elif len(kept) < len(queue):
+                self.pending[connection_id] = kept
+        return pruned
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.pending.values())
+
+
+class CodeExpiry:
+    """
+    Expiration of the codes of all the sessions in one heap, so that a sweep only visits the users whose codes are due, each in
+    O(log n), instead of every session. A response replaces all the codes of its user, so only the latest expiration of each user
+    counts: the entries of codes replaced before expiring are skipped when they reach the top, and the heap is rebuilt when
+    they outnumber the valid ones
+    """
+
+    def __init__(self):
+        self.heap: list[tuple[float, str]] = []
+        self.expirations: dict[str, float] = {}
+
+    def schedule(self, user: str, expiration: float):
+        if self.expirations.get(user, expiration) > expiration:
+            return
+        self.expirations[user] = expiration
+        heapq.heappush(self.heap, (expiration, user))
+        if len(self.heap) > 2 * len(self.expirations) + 64:
+            self.heap = [(expiration, user) for user, expiration in self.expirations.items()]
+            heapq.heapify(self.heap)
+
+    def due(self, now: float) -> list[tuple[str, float]]:
+        """
+        Removes and returns the (user, expiration) expired before now
+        """
+        users = []
+        while len(self.heap) > 0 and self.heap[0][0] < now:
+            expiration, user = heapq.heappop(self.heap)
+            if self.expirations.get(user) == expiration:
+                del self.expirations[user]
+                users.append((user, expiration))
+        return users
+
+    def __len__(self):
+        return len(self.expirations)
+
+
+class SessionRetention:
+    """
+    Bounds the memory held by the sessions: only the last max_messages messages of each user are kept, users idle for more than
+    idle_seconds are forgotten, and expired codes are removed from every session as scheduled by code_expiry, even if their user
+    never comes back. The pending requests of the forgotten users and messages are dropped from the connection index
+    """
+
+    def __init__(self, max_messages: int | None = MAX_MESSAGES_PER_USER, idle_seconds: float | None = SESSION_IDLE_SECONDS, sweep_interval: float = SWEEP_INTERVAL_SECONDS, code_expiry: CodeExpiry | None = None):
+        self.max_messages = max_messages
+        self.idle_seconds = idle_seconds
+        self.sweep_interval = sweep_interval
+        self.code_expiry = CodeExpiry() if code_expiry is None else code_expiry
+        self.last_sweep = 0
+        self.evicted_messages = 0
+        self.evicted_users = 0
+        self.expired_codes = 0
+        self.evicted_requests = 0
+
+    def new_session(self, **fields) -> dict:
+        return {"messages": deque(maxlen=self.max_messages), "last_seen": time.time(), **fields}
+
+    def append(self, user_session: dict, message: object):
+        messages = user_session["messages"]
+        if len(messages) == messages.maxlen:
+            self.evicted_messages += 1
+        messages.append(message)
+        user_session["last_seen"] = time.time()
+
+    def set_codes(self, user: str, user_session: dict, codes: dict, expiration: float):
+        """
+        Replaces the codes of the user, all expiring at expiration
+        """
+        user_session["codes"] = codes
+        if len(codes) > 0:
+            self.code_expiry.schedule(user, expiration)
+
+    def expire_codes(self, user_session: dict, now: float) -> int:
+        codes = user_session.get("codes", {})
+        expired = [n for n, code in codes.items() if code["expiration"] < now]
+        for n in expired:
+            del codes[n]
+        self.expired_codes += len(expired)
+        return len(expired)
+
+    def sweep(self, session: dict, force: bool = False, connections: ConnectionIndex | None = None) -> bool:
+        """
+        Runs at most every sweep_interval seconds, unless forced. Returns whether it ran
+        """
+        now = time.time()
+        if not force and now - self.last_sweep < self.sweep_interval:
+            return False
+        self.last_sweep = now
+        if self.idle_seconds is not None:
+            cutoff = now - self.idle_seconds
+            if hasattr(session, "idle_keys"):
+                idle_users = session.idle_keys(cutoff)
+            else:
+                idle_users = [user for user, user_session in session.items() if user_session["last_seen"] < cutoff]
+            for user in idle_users:
+                del session[user]
+                self.evicted_users += 1
+        if connections is not None:
+            self.evicted_requests += connections.prune(session, self.max_messages)
+        for user, expiration in self.code_expiry.due(now):
+            if user not in session:
+                continue
+            if hasattr(session, "lock") and not session.lock(user, blocking=False):  # Being handled by another process, try at the next sweep
+                self.code_expiry.schedule(user, expiration)
+                continue
+            user_session = session[user]
+            if self.expire_codes(user_session, now) > 0:
+                session[user] = user_session
+            if len(user_session.get("codes", {})) > 0:
+                self.code_expiry.schedule(user, min(code["expiration"] for code in user_session["codes"].values()))
+        return True
+
+    def stats(self) -> dict:
+        return {"evicted_messages": self.evicted_messages, "evicted_users": self.evicted_users, "expired_codes": self.expired_codes, "evicted_requests": self.evicted_requests, "scheduled_codes": len(self.code_expiry)}
+
+
+class Transition:
+    __slots__ = ("to_state", "message_type")
+
+    def __init__(self, to_state: int, message_type: Type[MessageType]):
+        self.to_state = to_state
+        self.message_type = message_type
+
+    def __repr__(self):
+        return f"Transition(to_state={self.to_state}, message_type={self.message_type})"
+
+
+class State:
+    __slots__ = ("transitions",)
+
+    def __init__(self, transitions: list[Transition]):
+        self.transitions = transitions
+
+    def __repr__(self):
+        return f"State(transitions={self.transitions})"
+
+
+# testing fsm looping through all states (the weird order is to stay consistent with the numbering of the production graph)
+# states = [
+#     State([Transition(1, InitMessageType)]),
+#     State([Transition(4, BuildProductMessageType)]),
+#     State([Transition(3, CategoriesMessageType)]),
+#     State([Transition(6, ProductPurchaseMessageType)]),
+#     State([Transition(5, ProductImageMessageType)]),
+#     State([Transition(2, ProductsMessageType)]),
+#     State([Transition(7, PhotographerRegisterMessageType)]),
+#     State([Transition(8, PhotoRequestMessageType)]),
+#     State([Transition(0, PhotoAssignmentMessageType)]),
+# ]
+
+# testing fsm looping through all states (no weird order)
+states = [
+    State([Transition(1, InitMessageType)]),
+    State([Transition(2, BuildProductMessageType)]),
+    State([Transition(3, ProductImageMessageType)]),
+    State([Transition(4, ProductsMessageType)]),
+    State([Transition(5, CategoriesMessageType)]),
+    State([Transition(6, ProductPurchaseMessageType)]),
+    State([Transition(7, PhotographerRegisterMessageType)]),
+    State([Transition(8, PhotoRequestMessageType)]),
+    State([Transition(0, PhotoAssignmentMessageType)]),
+]
+
+# possible fsm in production
+# states = [
+#     State([Transition(1, InitMessageType)]),
+#     State([Transition(2, ProductsMessageType),
+#            Transition(3, CategoriesMessageType),
+#            Transition(4, BuildProductMessageType),
+#            Transition(7, PhotographerRegisterMessageType)]
+#           ),
+#     State([Transition(6, ProductPurchaseMessageType)]
+#           ),
+#     State([Transition(2, ProductsMessageType),
+#            Transition(4, BuildProductMessageType)]
+#           ),
+#     State([Transition(5, ProductImageMessageType),
+#            Transition(8, PhotoRequestMessageType)]
+#           ),
+#     State([Transition(2, ProductsMessageType),
+#            Transition(3, CategoriesMessageType),
+#            Transition(4, BuildProductMessageType),
+#            Transition(7, PhotographerRegisterMessageType)]
+#           ),
+#     State([Transition(2, ProductsMessageType),
+#            Transition(3, CategoriesMessageType),
+#            Transition(4, BuildProductMessageType),
+#            Transition(6, ProductPurchaseMessageType),
+#            Transition(7, PhotographerRegisterMessageType)]
+#           ),
+#     State([Transition(9, PhotoAssignmentMessageType)]
+#           ),
+#     State([Transition(2, ProductsMessageType),
+#            Transition(3, CategoriesMessageType),
+#            Transition(4, BuildProductMessageType),
+#            Transition(7, PhotographerRegisterMessageType)]
+#           ),
+#     State([Transition(9, PhotoAssignmentMessageType)]
+#           )
+# ]
+
+
+class CompiledFSM:
+    """
+    The states compiled at load time into read-only tables: for each state the next state reached by each allowed message type,
+    and the X-Code header of each message type, so that routing a message costs the same however many transitions there are
+    """
+
+    def __init__(self, states: list[State], router: MessageRouter = message_router):
+        self.router = router
+        transitions = []
+        for i, state in enumerate(states):
+            next_states = {}
+            for transition in state.transitions:
+                if not 0 <= transition.to_state < len(states):
+                    raise ValueError(f"Transition from state {i} to missing state {transition.to_state}")
+                next_states.setdefault(transition.message_type, transition.to_state)  # As the first matching transition always had precedence
+            transitions.append(MappingProxyType(next_states))
+        self.transitions = tuple(transitions)
+        self._code_headers = None
+
+    @property
+    def code_headers(self) -> MappingProxyType:
+        """
+        Built the first time a code is sent, so that the handlers forwarding other messages don't have to import hashlib
+        """
+        if self._code_headers is None:
+            import hashlib
+            message_types = list(self.router.routes.values()) + list(self.router.unrouted)
+            self._code_headers = MappingProxyType({message_type: "X-Code-" + hashlib.md5(message_type.url.encode("utf-8")).hexdigest() for message_type in message_types})
+        return self._code_headers
+
+    def next_state(self, state: int, message_type: Type[MessageType]) -> int | None:
+        """
+        None if the message type is not allowed in the state
+        """
+        return self.transitions[state].get(message_type)
+
+
+fsm = CompiledFSM(states)
+
+
+def timing(connection_id: int, is_response: bool, event: str, file=None):
+    """
+    Timestamped stage marker, in the format parsed by PerformanceMeasuring/plotTxt.py
+    """
+    print(time.time_ns(), "splice", connection_id, "(client-side):" if is_response else "(server-side):", event, file=sys.stderr if file is None else file, flush=True)
+
+
+def plog(*args, **kwargs):
+    from pprint import pprint
+    pprint(*args, stream=sys.stderr, **kwargs)
+
+
+def generate_code():
+    return os.urandom(8).hex()
+
+
+class Verifier:
+    """
+    FSM verification of the FaaS traffic, independent of how messages are delivered.
+    The same instance is used once by randomize.py (state loaded from and committed to a session store) or kept alive by listener.py
+    """
+
+    def __init__(self, session: dict | None = None, waiting_bodies: dict | None = None, connections: ConnectionIndex | None = None, retention: SessionRetention | None = None):
+        self.session = {} if session is None else session
+        self.waiting_bodies = {} if waiting_bodies is None else waiting_bodies
+        self.connections = ConnectionIndex() if connections is None else connections
+        self.retention = SessionRetention() if retention is None else retention
+        self.check_codes = True  # Unless the codes of the responses can't reach the client (auditor.py)
+
+    def sweep(self) -> bool:
+        if self.retention.sweep(self.session, connections=self.connections):
+            event_log.info("Session sweep: %s", self.retention.stats())
+            return True
+        return False
+
+    def process(self, connection_id: int, is_response: bool, input_data: bytes | str) -> bytes | None:
+        """
+        Returns the data to forward (empty if the message is waiting for the rest of its body), or None if the message must be blocked.
+        An allowed request is forwarded as the same bytes received, only the header block and the inspected JSON body are decoded.
+        """
+        if isinstance(input_data, str):
+            input_data = input_data.encode("utf-8", "surrogateescape")
+        event_log.debug("%s", Payload(input_data))
+        key = self.waiting_key(connection_id, is_response)
+        parser = self.waiting_bodies[key] if key in self.waiting_bodies else HttpParser(is_response, headers_only=is_response)  # Responses are only seen in the header context
+        try:
+            passed = parser.pass_body(input_data)
+            if passed and parser.passthrough_blocked:
+                event_log.verdict(connection_id, is_response, BLOCK, None, None, "body of a blocked request")
+                if parser.passthrough == 0:
+                    del self.waiting_bodies[key]
+                else:
+                    self.waiting_bodies[key] = parser
+                return None
+            messages = parser.feed(input_data[len(passed):] if passed else input_data)
+            if not is_response and self.decided_by_headers(parser):
+                messages.append(parser.release())
+        except InvalidMessage as e:
+            event_log.verdict(connection_id, is_response, BLOCK, None, None, str(e))
+            if key in self.waiting_bodies:
+                del self.waiting_bodies[key]
+            return None
+
+        if len(parser) > 0 or parser.passthrough > 0:
+            event_log.debug("Waiting for body for connection %s (%s bytes received)", connection_id, len(parser))
+            self.waiting_bodies[key] = parser
+        elif key in self.waiting_bodies:
+            del self.waiting_bodies[key]
+
+        outputs = [passed] if passed else []  # The rest of the body of a request already allowed from its header
+        for message in messages:
+            if not is_response:
+                method, uri, http_version = message.start
+                event_log.debug("method: %s, uri: %s, http_version: %s", method, uri, http_version)
+                message_output = self.process_request(connection_id, ParsedRequest(method, uri, message.headers, message.body), message.raw)
+            else:
+                http_version, response_code = message.start
+                message_output = self.process_response(connection_id, http_version, int(response_code), message.headers, message.raw)
+            if message_output is None:
+                if not is_response:  # The requests pipelined before it are blocked with it, so they won't get a response
+                    for _ in outputs[1 if passed else 0:]:
+                        self.discard_request(connection_id)
+                if parser.passthrough > 0:  # It was released, the rest of its body is blocked too
+                    parser.passthrough_blocked = True
+                    self.waiting_bodies[key] = parser
+                return None
+            outputs.append(message_output)
+        return outputs[0] if len(outputs) == 1 else b"".join(outputs)
+
+
+    @staticmethod
+    def decided_by_headers(parser: HttpParser) -> bool:
+        """
+        Whether the request whose header has been received, while its body hasn't, is of a headers_only type,
+        so that it can be verified and forwarded at once instead of waiting for the body
+        """
+        if parser.start is None or parser.content_length is None:
+            return False
+        method, uri, _ = parser.start
+        message_type = fsm.router.route(ParsedRequest(method, uri, parser.headers, b""))
+        return message_type is not None and message_type.headers_only
+
+    def discard_request(self, connection_id: int):
+        """
+        Forgets the newest pending request of the connection, allowed but then not forwarded
+        """
+        pending = self.connections.discard(connection_id)
+        if pending is not None and pending[1] is not None:
+            pending[1].valid = False
+
+    @staticmethod
+    def waiting_key(connection_id: int, is_response: bool) -> str:
+        """
+        Key of the partial message of a connection in waiting_bodies
+        """
+        return f"{connection_id}-{'response' if is_response else 'request'}"
+
+    @staticmethod
+    def bearer_token(headers: dict[str, str]) -> str | None:
+        id_token = headers.get("Authorization")
+        if id_token is not None and id_token.startswith("Bearer "):
+            id_token = id_token[7:]
+        return id_token
+
+    @staticmethod
+    def claimed_user(headers: dict[str, str]) -> str:
+        """
+        The email in the token, not verified: only to choose the worker that authenticates the request (workerPool.py),
+        so a forged token only changes which worker rejects it
+        """
+        id_token = Verifier.bearer_token(headers)
+        try:
+            return unverified_claims(id_token)["email"] if id_token is not None else "Unknown"
+        except (ValueError, IndexError, KeyError, TypeError):
+            return "Unknown"
+
+    @staticmethod
+    def authenticate(headers: dict[str, str]) -> str:
+        user = "Unknown"
+        if "Authorization" in headers:
+            try:
+                user = parse_jwt(Verifier.bearer_token(headers))["email"]
+            except Exception as e:
+                event_log.warning("Couldn't get email from token: %s", e)
+        else:
+            event_log.debug("No auth token in request")
+        return user
+
+    @staticmethod
+    def code_matches(user_session: dict, message_type: Type[MessageType], code: str | None) -> bool:
+        """
+        Codes are looked up by message type; an expired code stays in the session until the next sweep, so its expiration is checked here
+        """
+        expected = user_session["codes"].get(message_type)
+        return expected is not None and expected["code"] == code and expected["expiration"] >= time.time()
+
+    def process_request(self, connection_id: int, request: ParsedRequest, input_data: bytes) -> bytes | None:
+        session = self.session
+        headers = request.headers
+
+        user = self.authenticate(headers)
+
+        user_session_tmp = session.get(user) or self.retention.new_session(state=0, codes={})  # To keep the session list clean, initialize a new session now but save it later only if there's a match
+        code = headers.get("X-Code", None)
+        message_type = fsm.router.route(request)
+        if message_type is not None:
+            reason = None
+            state = user_session_tmp["state"]
+            for pending in self.connections.pending_messages(connection_id, user):  # Pipelined: allowed only in the state after the requests before it
+                if state is not None:
+                    state = fsm.next_state(state, pending.type)
+            if state is None or fsm.next_state(state, message_type) is None:
+                reason = f"not allowed in state {state}" if state is not None else "not allowed after the pending requests"
+            elif not (message_type.headers_only or MessageType.validate_schemas(message_type, request)):
+                reason = "not matching schema"
+            elif self.check_codes and not (self.code_matches(user_session_tmp, message_type, code) or message_type == InitMessageType or "X-Testing" in headers):
+                reason = "invalid code"
+            valid = reason is None
+
+        if message_type is None:
+            event_log.verdict(connection_id, False, BLOCK, user, None, "no match")
+            return None
+        session[user] = user_session_tmp
+        message = Message(connection_id, message_type, valid, 0)
+        self.retention.append(session[user], message)
+        if not valid:
+            event_log.verdict(connection_id, False, BLOCK, user, message_type, reason)
+            return None
+        self.connections.add(connection_id, user, message)
+        event_log.verdict(connection_id, False, ALLOW, user, message_type)
+        return input_data
+
+    def process_response(self, connection_id: int, http_version: str, response_code: int, headers: dict[str, str], input_data: bytes) -> bytes | None:
+        session = self.session
+        output = b""
+        pending = self.connections.pop(connection_id)
+        if pending is None:
+            event_log.verdict(connection_id, True, DROP, None, None, "no pending request")
+        elif pending[0] not in session or pending[1] is None:
+            event_log.verdict(connection_id, True, PASS, pending[0], None, "session expired")
+            output = input_data
+        else:
+            user, message = pending
+            message_type = message.type
+            next_state = fsm.next_state(session[user]["state"], message_type)
+            if response_code == 200 and next_state is None:  # Another request of the user changed the state in the meantime
+                event_log.verdict(connection_id, True, BLOCK, user, message_type, f"no longer allowed in state {session[user]['state']}")
+                output = None
+            elif response_code == 200:
+                session[user]["state"] = next_state
+                expiration = time.time() + CODE_EXPIRATION_SECONDS
+                self.retention.set_codes(user, session[user], {mt: {"code": generate_code(), "expiration": expiration} for mt in fsm.transitions[next_state]}, expiration)
+                codes = "".join(f"{fsm.code_headers[k]}: {v['code']}\r\n" for k, v in session[user]["codes"].items()).encode("utf-8")
+                end = input_data.find(b"\r\n\r\n") + 2  # The codes are inserted at the end of the header block, the rest is forwarded as received
+                output = input_data[:end] + codes + input_data[end:]
+                event_log.verdict(connection_id, True, ALLOW, user, message_type, f"state {next_state}")
+                event_log.debug("%s", Payload(output))
+            else:
+                event_log.verdict(connection_id, True, PASS, user, message_type, f"response code {response_code}")
+                output = input_data
+            message.response_code = response_code
+            session[user]["last_seen"] = time.time()
+        return output
+
@@ -0,0 +1,220 @@
+import asyncio
+import multiprocessing
+import os
+import pickle
+import queue
+import signal
+import zlib
+from collections import deque
+from MessageTypes import *
+from eventLog import event_log, AsyncSink, BLOCK
+from httpParser import HttpMessage, HttpParser, InvalidMessage
+from jwtParser import signing_keys, verified_tokens
+from sessionStore import PickleStore
+from verifier import Verifier, plog, timing
+
+# Verification spread over several processes, for listener.py --workers: the front (the listener's event loop) reassembles the
+# messages, then sends each complete message, already parsed, to the worker owning its user, chosen by a hash of the email
+# claimed by the token, so that every session lives in a single worker and its transitions are verified one at a time, in order.
+# The token is verified by the worker, so the front only frames the messages. A response goes to the worker of the oldest
+# request of its connection still waiting for one
+
+
+def shard_file(filename: str | None, index: int, workers: int) -> str | None:
+    """
+    The file of a worker: session.dat is session-0-of-4.dat for the first of 4 workers, so changing the number of workers starts from new sessions
+    """
+    if filename is None or workers == 1:
+        return filename
+    base, extension = os.path.splitext(filename)
+    return f"{base}-{index}-of-{workers}{extension}"
+
+
+def pack(message: HttpMessage) -> tuple:
+    """
+    (start, headers, raw, body) of a message to send to a worker. A body that is a view of raw is always its end (HttpParser),
+    so only its offset is sent
+    """
+    raw = bytes(message.raw)
+    if isinstance(message.body, memoryview):
+        return message.start, message.headers, raw, len(raw) - len(message.body)
+    return message.start, message.headers, raw, bytes(message.body)
+
+
+def sweep(index: int, verifier: Verifier):
+    if verifier.sweep():
+        event_log.info("Worker %s JWT cache: %s", index, verified_tokens.stats())
+
+
+def run_worker(index: int, workers: int, tasks: multiprocessing.Queue, results, args):
+    """
+    Receives (seq, connection_id, is_response, start, headers, raw, body) and answers (seq, output), until None; body is the
+    offset of the body in raw when it is its end (see pack). A request released before the end of its body
+    (Verifier.decided_by_headers) is verified on what was received.
+    "dump" prints the sessions of the worker, as SIGUSR1 does for the whole listener, and ("discard", connection_id) forgets the
+    newest pending request of the connection
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Stopped by the front, after the last message. The schemas were compiled before the fork
+    event_log.set_sink(AsyncSink())
+    store = PickleStore(shard_file(args.session_file, index, workers), None)
+    store.retention.max_messages, store.retention.idle_seconds = args.max_messages, args.idle_seconds
+    verifier = Verifier(store.session, store.waiting_bodies, store.connections, store.retention)
+    signing_keys.refresh_in_background()  # The front doesn't verify the tokens
+    while True:
+        try:
+            task = tasks.get(timeout=verifier.retention.sweep_interval)
+        except queue.Empty:
+            sweep(index, verifier)
+            continue
+        if task is None:
+            break
+        if task == "dump":
+            event_log.flush()
+            plog(verifier.session)
+            log(f"Worker {index}: {len(verifier.session)} users, {len(verifier.connections)} pending requests")
+            continue
+        if task[0] == "discard":
+            verifier.discard_request(task[1])
+            continue
+        seq, connection_id, is_response, start, headers, raw, body = task
+        stage = "processResponse" if is_response else "processRequest"
+        timing(connection_id, is_response, stage + " started")
+        try:
+            if is_response:
+                output = verifier.process_response(connection_id, start[0], int(start[1]), headers, raw)
+            else:
+                body = memoryview(raw)[body:] if isinstance(body, int) else body
+                output = verifier.process_request(connection_id, ParsedRequest(start[0], start[1], headers, body), raw)
+        except Exception as e:  # The worker must outlive a bug in the verification, or every later message of its users would wait forever
+            event_log.error("Error verifying a message of connection %s: %r", connection_id, e)
+            output = None
+        timing(connection_id, is_response, stage + " finished")
+        results.send((seq, output))
+        sweep(index, verifier)
+    event_log.info("Worker %s JWT cache: %s", index, verified_tokens.stats())
+    event_log.sink.close()
+    store.commit()
+
+
+class WorkerPool:
+    """
+    Same role as Verifier.process for listener.py, with the verification done by the workers.
+    The partial messages are kept by the front, so the workers only receive complete messages
+    """
+
+    def __init__(self, workers: int, args):
+        self.workers = workers
+        self.args = args
+        self.tasks = []
+        self.results = []
+        self.processes = []
+        self.loop = None
+        self.futures: dict[int, asyncio.Future] = {}
+        self.seq = 0
+        self.owners: dict[int, deque[int]] = {}  # Workers of the requests of a connection waiting for their response, oldest first
+        self.waiting_file = args.waiting_file
+        self.waiting_bodies = {}
+        if self.waiting_file is not None and os.path.isfile(self.waiting_file):
+            self.waiting_bodies = pickle.load(open(self.waiting_file, "rb"))
+
+    def start(self):
+        """
+        Must run before the event loop and any thread are started, since the workers are forked
+        """
+        context = multiprocessing.get_context("fork")  # The workers inherit the compiled schemas and the signing keys
+        for index in range(self.workers):
+            tasks = context.Queue()
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=run_worker, args=(index, self.workers, tasks, sender, self.args), name=f"worker-{index}", daemon=True)
+            process.start()
+            sender.close()
+            self.tasks.append(tasks)
+            self.results.append(receiver)
+            self.processes.append(process)
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        for receiver in self.results:
+            loop.add_reader(receiver.fileno(), self.receive, receiver)
+
+    def receive(self, receiver):
+        seq, output = receiver.recv()
+        future = self.futures.pop(seq, None)
+        if future is not None and not future.done():
+            future.set_result(output)
+
+    def submit(self, worker: int, connection_id: int, is_response: bool, message: HttpMessage) -> asyncio.Future:
+        self.seq += 1
+        future = asyncio.get_running_loop().create_future()
+        self.futures[self.seq] = future
+        self.tasks[worker].put((self.seq, connection_id, is_response, *pack(message)))
+        return future
+
+    def worker_of(self, user: str) -> int:
+        return zlib.crc32(user.encode("utf-8")) % self.workers
+
+    async def process(self, connection_id: int, is_response: bool, input_data: bytes | str) -> bytes | None:
+        if isinstance(input_data, str):
+            input_data = input_data.encode("utf-8", "surrogateescape")
+        key = Verifier.waiting_key(connection_id, is_response)
+        parser = self.waiting_bodies[key] if key in self.waiting_bodies else HttpParser(is_response, headers_only=is_response)
+        try:
+            passed = parser.pass_body(input_data)
+            if passed and parser.passthrough_blocked:
+                event_log.verdict(connection_id, is_response, BLOCK, None, None, "body of a blocked request")
+                if parser.passthrough == 0:
+                    del self.waiting_bodies[key]
+                else:
+                    self.waiting_bodies[key] = parser
+                return None
+            messages = parser.feed(input_data[len(passed):] if passed else input_data)
+            released = parser.release() if not is_response and Verifier.decided_by_headers(parser) else None
+        except InvalidMessage as e:
+            event_log.verdict(connection_id, is_response, BLOCK, None, None, str(e))
+            self.waiting_bodies.pop(key, None)
+            return None
+        if len(parser) > 0 or parser.passthrough > 0:
+            self.waiting_bodies[key] = parser
+        else:
+            self.waiting_bodies.pop(key, None)
+
+        outputs = [passed] if passed else []  # As in Verifier.process
+        for message in messages + ([released] if released is not None else []):
+            if not is_response:
+                worker = self.worker_of(Verifier.claimed_user(message.headers))
+                output = await self.submit(worker, connection_id, False, message)
+                if output is not None:
+                    self.owners.setdefault(connection_id, deque()).append(worker)
+            else:
+                owners = self.owners.get(connection_id)
+                worker = owners.popleft() if owners else connection_id % self.workers  # Without a pending request, any worker reports it
+                if owners is not None and len(owners) == 0:
+                    del self.owners[connection_id]
+                output = await self.submit(worker, connection_id, True, message)
+            if output is None:
+                if not is_response:  # As in Verifier.process, the requests pipelined before it are blocked with it
+                    for _ in outputs[1 if passed else 0:]:
+                        self.tasks[self.owners[connection_id].pop()].put(("discard", connection_id))
+                    if not self.owners.get(connection_id, True):
+                        del self.owners[connection_id]
+                if parser.passthrough > 0:
+                    parser.passthrough_blocked = True
+                    self.waiting_bodies[key] = parser
+                return None
+            outputs.append(output)
+        return outputs[0] if len(outputs) == 1 else b"".join(outputs)
+
+    def dump(self):
+        for tasks in self.tasks:
+            tasks.put("dump")
+
+    def stop(self):
+        if self.loop is not None:
+            for receiver in self.results:
+                self.loop.remove_reader(receiver.fileno())
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join()
+        if self.waiting_file is not None:
+            pickle.dump(self.waiting_bodies, open(self.waiting_file, "wb"))
@@ -1,70 +1,140 @@
-import json
+import http.client
 import os
-import pickle
-import re
+import socket
+import struct
 import sys
-import urllib.request
+
+# Handler for Middlebox/listener.py: every fragment is sent as it is, and the listener reassembles the messages split over
+# several containers in memory, answering with empty data until a message is complete (client.go does its own reassembly for listener.go).
+# The message bytes go from stdin to the listener and back to stdout without being decoded.
+# The listener is reached on its Unix socket (listener.py --unix, MIDDLEBOX_SOCKET) with a binary frame per message, and through
+# HTTP on localhost:8080 when the socket is not available (or MIDDLEBOX_SOCKET is empty).
+# Unless MIDDLEBOX_VERDICT_ONLY=0, the listener doesn't send back the messages it allows unchanged, only the bytes it inserts
+# (the codes in the responses), and the handler writes its own copy of the message with them
+
+SOCKET_PATH = os.environ.get("MIDDLEBOX_SOCKET", "/tmp/middlebox.sock")
+VERDICT_ONLY = os.environ.get("MIDDLEBOX_VERDICT_ONLY", "1") == "1"
+# Same frames as Middlebox/listener.py
+REQUEST_FRAME = struct.Struct("!QBI")  # connection_id, flags, length of the message that follows
+REPLY_FRAME = struct.Struct("!BI")  # status, length of the data to forward (or of the insertion) that follows
+INSERTION = struct.Struct("!I")  # Offset in the message of the inserted bytes that follow
+RESPONSE_FLAG, VERDICT_ONLY_FLAG = 1, 2
+FORWARD, BLOCKED, INSERT = 0, 1, 2
+
 
 def log(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+class RemoteError(Exception):
+    pass
+
+
+class FrameConnection:
+    """
+    Connection to the Unix socket of the listener, opened at the first message and reused for the following ones
+    """
+
+    def __init__(self, path: str = SOCKET_PATH):
+        self.path = path
+        self.sock = None
+
+    def verify(self, connection_id: int, is_response: bool, data: bytes, verdict_only: bool = VERDICT_ONLY) -> list | None:
+        """
+        The parts of the data to forward, or None if the message is blocked
+        """
+        if self.sock is None:
+            self.connect()
+        flags = (RESPONSE_FLAG if is_response else 0) | (VERDICT_ONLY_FLAG if verdict_only else 0)
+        self.sock.sendall(REQUEST_FRAME.pack(connection_id, flags, len(data)))
+        self.sock.sendall(data)
+        status, length = REPLY_FRAME.unpack(self.receive(REPLY_FRAME.size))
+        output = self.receive(length)
+        if status == INSERT:
+            return insert(data, INSERTION.unpack_from(output)[0], memoryview(output)[INSERTION.size:])
+        return [output] if status == FORWARD else None
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.path)
+        except OSError:
+            self.close()
+            raise
+
+    def receive(self, size: int) -> bytearray:
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        while len(view) > 0:
+            received = self.sock.recv_into(view)
+            if received == 0:
+                self.close()
+                raise ConnectionResetError("Listener closed the connection")
+            view = view[received:]
+        return buffer
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def insert(data: bytes, offset: int, inserted: bytes) -> list:
+    """
+    The parts of data with inserted at offset, without copying data
+    """
+    view = memoryview(data)
+    return [view[:offset], inserted, view[offset:]]
+
+
+def verify_http(connection_id: int, is_response: bool, data: bytes, port: int = 8080, verdict_only: bool = VERDICT_ONLY) -> list | None:
+    connection = http.client.HTTPConnection("localhost", port)
+    headers = {"Content-Type": "application/octet-stream", "X-Connection-Id": str(connection_id), "X-Is-Response": str(int(is_response))}
+    if verdict_only:
+        headers["X-Verdict-Only"] = "1"
+    connection.request("POST", "/", body=data, headers=headers)
+    response = connection.getresponse()
+    out = response.read()
+    connection.close()
+    if response.status == 200 and response.getheader("X-Insert-At") is not None:
+        return insert(data, int(response.getheader("X-Insert-At")), out)
+    if response.status == 200:
+        return [out]
+    if response.status == 403:
+        return None
+    raise RemoteError(f"{response.status} {response.reason}")
+
+
 def main():
-    waiting_bodies = {}
-    if os.path.isfile("../Middlebox/waiting.dat"):
-        waiting_bodies = pickle.load(open("../Middlebox/waiting.dat", "rb"))
     connection_id = int(sys.argv[1])
     splice_id = int(sys.argv[2])
     is_response = bool(int(sys.argv[3]))
-    input_data = sys.stdin.read()
+    input_data = sys.stdin.buffer.read()
     if input_data is None:
         return
-    log("\033[1;2m" + input_data + "\033[0m")
-    if connection_id in waiting_bodies:
-        body = input_data
-        headers, old_body, old_header = waiting_bodies[connection_id]
-        input_data = old_header + "\r\n\r\n" + old_body + input_data
-        body = old_body + body
-    else:
-        header, body = input_data.split("\r\n\r\n", 1)
-        tmp = header.split("\r\n")
-        req = tmp.pop(0)
-
-        if not is_response:
-            match = re.match(r"(GET|POST|HEAD|PUT|DELETE) ([^ ]+) HTTP/(\d+(?:\.\d+)?)", req)
-            if not match:
-                log("Invalid request")
-                sys.exit(1)
-        else:
-            match = re.match(r"HTTP/(\d+(?:\.\d+)?) (\d+)", req)
-            if not match:
-                log("Invalid response")
-                sys.exit(1)
-
-        headers = {line.split(": ")[0].title(): line.split(": ", 1)[1] for line in tmp}
-
-    if not is_response and len(body) < int(headers.get("Content-Length", 0)):
-        log("Waiting for body for connection " + str(connection_id))
-        waiting_bodies[connection_id] = headers, body, header
-        log(waiting_bodies)
-        pickle.dump(waiting_bodies, open("../Middlebox/waiting.dat", "wb"))
-        sys.exit(0)
-    elif connection_id in waiting_bodies:
-        del waiting_bodies[connection_id]
-        pickle.dump(waiting_bodies, open("../Middlebox/waiting.dat", "wb"))
 
+    connection = None
+    if SOCKET_PATH and os.path.exists(SOCKET_PATH):
+        connection = FrameConnection()
+        try:
+            connection.connect()
+        except OSError as e:  # Once connected the message may have been verified, so there is no fallback for the later errors
+            log(f"Can't connect to {SOCKET_PATH}: {e}, falling back to HTTP")
+            connection = None
     try:
-        out = json.loads(urllib.request.urlopen("http://localhost:8080", data=json.dumps({"connection_id": connection_id, "is_response": is_response, "data": input_data}).encode()).read().decode())
-        log(out)
-        if out["success"]:
-            print(out["data"], end="")
-            sys.exit(0)
+        if connection is not None:
+            out = connection.verify(connection_id, is_response, input_data)
         else:
-            log("Invalid request/response")
-    except json.decoder.JSONDecodeError:
-        log("Remote error")
-    sys.exit(1)
-
+            out = verify_http(connection_id, is_response, input_data)
+    except (OSError, RemoteError) as e:
+        log("Remote error: " + str(e))
+        sys.exit(1)
+    if out is None:
+        log("Invalid request/response")
+        sys.exit(1)
+    for part in out:
+        sys.stdout.buffer.write(part)
+    sys.exit(0)
 
 
 if __name__ == "__main__":
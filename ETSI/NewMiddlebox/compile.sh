@@ -8,5 +8,6 @@ if [ ! -f $go ]; then
     go="go"
 fi
 "$go" build -o client client.go
+"$go" build -o launcher launcher.go
 "$go" build -o listener_empty listener.go emptyHandler.go
 "$go" build -o listener listener.go middleboxHandler.go messageTypes.go
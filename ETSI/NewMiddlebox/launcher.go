@@ -0,0 +1,47 @@
+package main
+
+import (
+	"fmt"
+	"net"
+	"os"
+	"strconv"
+	"strings"
+	"syscall"
+	"time"
+)
+
+// Per-message handler for tlmsp-mb that doesn't run the verification itself: it passes its stdin, stdout, stderr and
+// arguments to Middlebox/forkServer.py, which forks a pre-warmed handler for the message, and exits with its status
+
+func main() {
+	connectionID, _ := strconv.Atoi(os.Args[1])
+	isResponse, _ := strconv.ParseBool(os.Args[3])
+	side := "(server-side)"
+	if isResponse {
+		side = "(client-side)"
+	}
+	fmt.Fprintln(os.Stderr, time.Now().UnixNano(), "splice", connectionID, side+": Client started")
+	socketPath := os.Getenv("FORK_SERVER_SOCKET")
+	if socketPath == "" {
+		socketPath = "/tmp/middlebox-fork.sock"
+	}
+	conn, err := net.DialUnix("unix", nil, &net.UnixAddr{Name: socketPath, Net: "unix"})
+	if err != nil {
+		fmt.Fprintf(os.Stderr, "Error connecting to the fork server: %v\n", err)
+		os.Exit(1)
+	}
+	rights := syscall.UnixRights(int(os.Stdin.Fd()), int(os.Stdout.Fd()), int(os.Stderr.Fd()))
+	if _, _, err := conn.WriteMsgUnix([]byte(strings.Join(os.Args[1:4], " ")), rights, nil); err != nil {
+		fmt.Fprintf(os.Stderr, "Error sending the message to the fork server: %v\n", err)
+		os.Exit(1)
+	}
+	status := make([]byte, 16)
+	n, _ := conn.Read(status)
+	code, err := strconv.Atoi(strings.TrimSpace(string(status[:n])))
+	if err != nil {
+		fmt.Fprintln(os.Stderr, "The handler terminated without a status")
+		code = 1
+	}
+	fmt.Fprintln(os.Stderr, time.Now().UnixNano(), "splice", connectionID, side+": Client finished")
+	os.Exit(code)
+}
@@ -9,6 +9,7 @@ import (
 	"net/http/httputil"
 	"os"
 	"strings"
+	"sync"
 	"time"
 )
 
@@ -52,10 +53,10 @@ func handleRequest(w http.ResponseWriter, r *http.Request, params map[string]int
 	fmt.Fprintln(os.Stderr, time.Now().UnixNano(), "splice", params["connection_id"], "(server-side): processRequest finished")
 	var output map[string]interface{}
 	if valid {
-		requestInfo[int(params["connection_id"].(float64))] = map[string]interface{}{
+		pushRequestInfo(int(params["connection_id"].(float64)), map[string]interface{}{
 			"user":        user,
 			"messageType": messageType,
-		}
+		})
 		rawRequest, err := httputil.DumpRequest(request, true)
 		if err != nil {
 			log.Println("Error dumping request: " + err.Error())
@@ -87,7 +88,7 @@ func handleResponse(w http.ResponseWriter, r *http.Request, params map[string]in
 		return
 	}
 	log.Println("Parsed response: " + fmt.Sprint(response))
-	reqInfo, ok := requestInfo[int(params["connection_id"].(float64))]
+	reqInfo, ok := popRequestInfo(int(params["connection_id"].(float64)))
 	if !ok {
 		log.Println("No request info found for connection ID")
 		return
@@ -97,7 +98,6 @@ func handleResponse(w http.ResponseWriter, r *http.Request, params map[string]in
 	fmt.Fprintln(os.Stderr, time.Now().UnixNano(), "splice", params["connection_id"], "(client-side): processResponse started")
 	processResponse(response, user, messageType)
 	fmt.Fprintln(os.Stderr, time.Now().UnixNano(), "splice", params["connection_id"], "(client-side): processResponse finished")
-	delete(requestInfo, int(params["connection_id"].(float64)))
 	rawResponse, err := httputil.DumpResponse(response, true)
 	if err != nil {
 		log.Println("Error dumping response: " + err.Error())
@@ -126,7 +126,31 @@ func ParseRawHTTPResponse(raw string) (*http.Response, error) {
 	return http.ReadResponse(buf, nil)
 }
 
-var requestInfo = map[int]map[string]interface{}{}
+// Requests of each connection waiting for their response, oldest first: with keep-alive a connection carries several requests,
+// possibly pipelined, and each response answers the oldest one still pending
+var requestInfo = map[int][]map[string]interface{}{}
+var requestInfoLock sync.Mutex
+
+func pushRequestInfo(connectionID int, info map[string]interface{}) {
+	requestInfoLock.Lock()
+	defer requestInfoLock.Unlock()
+	requestInfo[connectionID] = append(requestInfo[connectionID], info)
+}
+
+func popRequestInfo(connectionID int) (map[string]interface{}, bool) {
+	requestInfoLock.Lock()
+	defer requestInfoLock.Unlock()
+	pending := requestInfo[connectionID]
+	if len(pending) == 0 {
+		return nil, false
+	}
+	if len(pending) == 1 {
+		delete(requestInfo, connectionID)
+	} else {
+		requestInfo[connectionID] = pending[1:]
+	}
+	return pending[0], true
+}
 
 func main() {
 	router := http.NewServeMux()
@@ -51,6 +51,7 @@ parser.add_argument('--go', metavar="CLIENT_PATH", help='Use the specified go cl
 parser.add_argument('-t', '--time', help='Duration of the test in seconds', type=int)
 parser.add_argument('-r', '--requests', help='Number of requests to send', type=int)
 parser.add_argument('-e', '--continue-on-error', help='Continue on error', action='store_true')
+parser.add_argument('-k', '--keep-alive', metavar="LOOPS", help='Send this many loops over the requests on the same connection (curl only)', type=int)
 
 try:
     with open("requestsNew.json") as f:
@@ -67,6 +68,10 @@ if args.go and args.tlmsp:
     log.error("Cannot use go client with TLMSP")
     exit(1)
 
+if args.go and args.keep_alive:
+    log.error("Cannot use go client with keep-alive")
+    exit(1)
+
 if args.time and args.requests:
     log.error("Cannot specify both time and requests")
     exit(1)
@@ -99,12 +104,19 @@ command = 'loop=' + str(random.randint(1000, 9999) * 1000) + '\n' \
           'date +%s%N\n' \
           'while true; do\n' \
           'let loop++\n'
-for r in requests:
-    data = r["post_data"]
-    # replace {} with loop number, escape the rest
-    data = map(shlex.quote, data.split("{}"))
-    data = "${loop}".join(data)
-    curl = (shlex.quote(os.path.abspath(args.go.name)) + ' --time ' if args.go else 'curl --fail'+('-with-body' if fail_with_body_supported else '')+' --insecure --silent -w \'%{time_total}\n\' ') + '--output /dev/null ' + ('--tlmsp ' + shlex.quote(args.tlmsp.name) + ' ' if args.tlmsp else '') + '-H "X-Testing: 1" -H "Authorization: Bearer ' + shlex.quote(args.auth_token) + '" -H "Content-Type: application/json" --data ' + data + ' ' + args.server_address.rstrip('/') + '/function/' + r["path"]
+curls = []
+for i in range(args.keep_alive or 1):
+    for r in requests:
+        data = r["post_data"]
+        # replace {} with loop number, escape the rest
+        data = map(shlex.quote, data.split("{}"))
+        data = ("${loop}" if i == 0 else f"$((loop + {i}))").join(data)
+        curl = (shlex.quote(os.path.abspath(args.go.name)) + ' --time ' if args.go else 'curl --fail'+('-with-body' if fail_with_body_supported else '')+' --insecure --silent -w \'%{time_total}\n\' ') + '--output /dev/null ' + ('--tlmsp ' + shlex.quote(args.tlmsp.name) + ' ' if args.tlmsp else '') + '-H "X-Testing: 1" -H "Authorization: Bearer ' + shlex.quote(args.auth_token) + '" -H "Content-Type: application/json" --data ' + data + ' ' + args.server_address.rstrip('/') + '/function/' + r["path"]
+        curls.append(curl)
+if args.keep_alive:
+    # A single curl for all the loops, reusing the connection: the options of each transfer are repeated after --next
+    curls = [' --next '.join([curls[0]] + [curl.removeprefix('curl ') for curl in curls[1:]])]
+for curl in curls:
     command += curl + '\n'
     command += 'returnCode=$?\n'
     command += 'if [ $returnCode -ne 0 ]; then\n'
@@ -119,6 +131,8 @@ for r in requests:
         command += 'exit 1\n'
     command += 'fi\n'
     command += 'echo -n "$returnCode "; date +%s%N\n'
+if args.keep_alive:
+    command += f'let loop+={args.keep_alive - 1}\n'
 command += 'done'
 # print(command)
 process = subprocess.Popen(command, shell=True, executable="/bin/bash", stdout=subprocess.PIPE, preexec_fn=os.setsid)
@@ -134,6 +148,8 @@ failed = 0
 start = time.time()
 last_print_time = 0
 line_type = 0
+transfers = len(requests) * args.keep_alive if args.keep_alive else 1  # Lines with the time of a request before each line with the exit code
+request_latencies = []
 poll_obj = select.poll()
 poll_obj.register(process.stdout, select.POLLIN)
 while True:
@@ -145,20 +161,25 @@ while True:
         if old_timestamp is None:
             old_timestamp = int(line)
             continue
-        if line_type == 0:
+        if line_type < transfers:
             request_latency = float(line.replace(",", "."))
+            request_latencies.append(request_latency)
             if request_latency * 1000 > max_latency_ms:
-                log.info(f"\033[1;33mRequest {total + 1} (type {(total % len(requests)) + 1}) took {round(request_latency * 1000, 1)}ms\033[0m\033[K")
-        elif line_type == 1:
+                log.info(f"\033[1;33mRequest {total + line_type + 1} (type {((total + line_type) % len(requests)) + 1}) took {round(request_latency * 1000, 1)}ms\033[0m\033[K")
+        else:
             code, timestamp = line.split()
             total_latency = (int(timestamp) - old_timestamp) / 1000000000
             old_timestamp = int(timestamp)
             fail = code != "0"
-            total += 1
-            if fail:
-                failed += 1
-            results.append({"fail": fail, "total_latency": total_latency, "request_latency": request_latency})
-        line_type = (line_type + 1) % 2
+            for request_latency in request_latencies:
+                total += 1
+                if fail:
+                    failed += 1
+                # With keep-alive the time of the whole connection is split between its requests
+                share = total_latency if transfers == 1 else total_latency * request_latency / sum(request_latencies)
+                results.append({"fail": fail, "total_latency": share, "request_latency": request_latency})
+            request_latencies = []
+        line_type = (line_type + 1) % (transfers + 1)
     else:
         time.sleep(0.001)
     if old_timestamp is not None and time.time() - old_timestamp / 1000000000 >= 5: